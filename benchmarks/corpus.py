@@ -0,0 +1,138 @@
+# coding: utf-8
+
+import os
+import random
+import shutil
+import string
+import datetime
+import subprocess
+
+# the words the documents are made of
+vocabulary = ["the", "deployment", "of", "service", "configuration", "database", "release", "notes", "meeting", "team", "update", "server", "client",
+              "request", "response", "error", "backup", "monitoring", "pipeline", "build", "review", "access", "user", "account", "network", "cluster",
+              "migration", "schedule", "incident", "report", "customer", "feature", "test", "version", "branch", "ticket", "sprint", "planning"]
+
+
+def plant_secret(rng):
+    # secrets which are found by the default rules of gitleaks
+    kind = rng.randrange(3)
+    if kind == 0:
+        return "aws_access_key_id = AKIA" + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+    elif kind == 1:
+        return "github_token = ghp_" + "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(36))
+    return "password=\"" + "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(24)) + "\""
+
+
+class Corpus:
+    # every document is generated from the seed when it is requested, this way the corpus never needs to be held in memory
+    # and two runs with the same seed serve the same documents
+    def __init__(self, config):
+        self.seed = config["seed"]
+        self.num_spaces = config["num_spaces"]
+        self.pages_per_space = config["pages_per_space"]
+        self.num_projects = config["num_projects"]
+        self.issues_per_project = config["issues_per_project"]
+        self.comments_per_issue = config["comments_per_issue"]
+        self.num_repositories = config["num_repositories"]
+        self.files_per_repository = config["files_per_repository"]
+        self.words_per_document = config["words_per_document"]
+        self.secret_rate = config["secret_rate"]
+        self.updated_on = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).isoformat()
+
+    def get_rng(self, *key):
+        return random.Random("{}:{}".format(self.seed, ":".join(str(part) for part in key)))
+
+    def get_text(self, *key):
+        rng = self.get_rng(*key)
+        # the first draw decides whether the document contains a secret (see `count_secrets`)
+        has_secret = rng.random() < self.secret_rate
+
+        words = [rng.choice(vocabulary) for _ in range(self.words_per_document)]
+        lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        if has_secret:
+            lines.insert(rng.randrange(len(lines) + 1), plant_secret(rng))
+
+        return "\n".join(lines)
+
+    def has_secret(self, *key):
+        return self.get_rng(*key).random() < self.secret_rate
+
+    @staticmethod
+    def get_space_key(space):
+        return "SP{:03d}".format(space)
+
+    @staticmethod
+    def get_project_key(project):
+        return "PR{:03d}".format(project)
+
+    @staticmethod
+    def get_repository_slug(repository):
+        return "repo-{:03d}".format(repository)
+
+    def get_page_id(self, space, page):
+        return str(space * self.pages_per_space + page + 1)
+
+    def get_page_location(self, page_id):
+        return divmod(int(page_id) - 1, self.pages_per_space)
+
+    def get_page(self, space, page):
+        html = "".join("<p>{}</p>".format(line) for line in self.get_text("page", space, page).split("\n"))
+        return {"id": self.get_page_id(space, page), "type": "page", "status": "current", "title": "Page {} of {}".format(page, self.get_space_key(space)),
+                "body": {"storage": {"value": html, "representation": "storage"}}}
+
+    def get_comment(self, project, issue, comment):
+        return {"id": str(comment + 1), "body": self.get_text("comment", project, issue, comment)}
+
+    def get_issue(self, project, issue, embedded_comments):
+        return {"id": str(project * self.issues_per_project + issue + 1), "key": "{}-{}".format(self.get_project_key(project), issue + 1),
+                "fields": {"summary": "Issue {} of {}".format(issue + 1, self.get_project_key(project)), "description": self.get_text("issue", project, issue),
+                           "comment": {"comments": [self.get_comment(project, issue, comment) for comment in range(min(embedded_comments, self.comments_per_issue))],
+                                       "total": self.comments_per_issue, "startAt": 0, "maxResults": embedded_comments}}}
+
+    def count_documents(self):
+        return {"confluence": self.num_spaces * self.pages_per_space, "jira": self.num_projects * self.issues_per_project,
+                "bitbucket": self.num_repositories * self.files_per_repository}
+
+    def count_secrets(self):
+        return {"confluence": sum(self.has_secret("page", space, page) for space in range(self.num_spaces) for page in range(self.pages_per_space)),
+                "jira": sum(self.has_secret("issue", project, issue) + sum(self.has_secret("comment", project, issue, comment) for comment in range(self.comments_per_issue))
+                            for project in range(self.num_projects) for issue in range(self.issues_per_project)),
+                "bitbucket": sum(self.has_secret("file", repository, file) for repository in range(self.num_repositories) for file in range(self.files_per_repository))}
+
+    def count_bytes(self):
+        return {"confluence": sum(len(self.get_page(space, page)["body"]["storage"]["value"].encode("utf-8"))
+                                  for space in range(self.num_spaces) for page in range(self.pages_per_space)),
+                "jira": sum(len(self.get_text("issue", project, issue).encode("utf-8")) +
+                            sum(len(self.get_text("comment", project, issue, comment).encode("utf-8")) for comment in range(self.comments_per_issue))
+                            for project in range(self.num_projects) for issue in range(self.issues_per_project)),
+                "bitbucket": sum(len(self.get_text("file", repository, file).encode("utf-8"))
+                                 for repository in range(self.num_repositories) for file in range(self.files_per_repository))}
+
+    def create_repositories(self, path):
+        # the repositories are bare repositories cloned through file:// urls
+        for repository in range(self.num_repositories):
+            slug = self.get_repository_slug(repository)
+            bare_path = os.path.join(path, slug + ".git")
+            if os.path.exists(bare_path):
+                continue
+
+            work_path = os.path.join(path, slug)
+            os.makedirs(work_path)
+            for file in range(self.files_per_repository):
+                file_path = os.path.join(work_path, "src", "module{}".format(file % 10), "file{}.txt".format(file))
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                handle = open(file_path, "w")
+                handle.write(self.get_text("file", repository, file))
+                handle.close()
+
+            subprocess.run(["git", "init", "-q", work_path], check=True)
+            subprocess.run(["git", "-C", work_path, "add", "."], check=True)
+            subprocess.run(["git", "-C", work_path, "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "commit", "-q", "-m", "corpus"], check=True)
+            subprocess.run(["git", "clone", "-q", "--bare", work_path, bare_path], check=True)
+            shutil.rmtree(work_path)
+
+    def get_repository(self, repository, path):
+        slug = self.get_repository_slug(repository)
+        url = "file://" + os.path.abspath(os.path.join(path, slug + ".git"))
+        return {"type": "repository", "slug": slug, "name": slug, "full_name": "benchmark/" + slug, "updated_on": self.updated_on, "is_private": True,
+                "links": {"clone": [{"name": "https", "href": url}, {"name": "ssh", "href": url}]}}
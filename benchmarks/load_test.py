@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import logging
+import threading
+import subprocess
+import corpus as corpus_module
+import mock_atlassian
+
+# the analyzers are next to the benchmarks directory
+repository_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_path)
+
+import common
+
+# the program's name
+program_name = "load_test"
+# the program's version
+program_version = "1.0.0"
+# the logger to use throughout the program
+logger = logging.getLogger(program_name)
+# configuration of the load test (loaded from a json file and/or the program's arguments)
+config = {}
+
+# the analyzers which can be run, along with the unit of their documents
+analyzers = {"confluence": "pages", "jira": "issues", "bitbucket": "files"}
+# runs a command and writes the peak memory usage of the largest process it started (in kilobytes) to a file, this is
+# the peak of a single process (e.g. the main process or one of the analysis processes), not of the whole process tree
+measure_command = "import resource, subprocess, sys; code = subprocess.run(sys.argv[2:]).returncode; " \
+                  "open(sys.argv[1], 'w').write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)); sys.exit(code)"
+# how often the memory usage of the whole process tree of an analyzer is sampled (in seconds)
+memory_sampling_interval = 0.1
+
+
+class MemorySampler:
+    # samples the total resident memory of the descendants of a process through /proc (linux only), the pages shared by
+    # several processes (e.g. after a fork) are counted once per process
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def start(self):
+        if os.path.isdir("/proc/{}".format(self.pid)):
+            self.thread = threading.Thread(target=self.run, name="memory", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            descendants = self.get_descendants()
+            rss = sum(self.get_rss(pid) for pid in descendants)
+            if descendants and (self.peak_rss is None or rss > self.peak_rss):
+                self.peak_rss = rss
+            self.stopped.wait(self.interval)
+
+    def get_descendants(self):
+        # the parent of every process is read from its stat file (its name is between parentheses and may contain spaces)
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                stat_file = open("/proc/{}/stat".format(entry))
+                stat = stat_file.read()
+                stat_file.close()
+            except OSError:
+                continue
+            children.setdefault(int(stat.rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+
+        descendants = []
+        pending = list(children.get(self.pid, []))
+        while pending:
+            pid = pending.pop()
+            descendants.append(pid)
+            pending.extend(children.get(pid, []))
+        return descendants
+
+    def get_rss(self, pid):
+        # the process may have exited since it was listed
+        try:
+            statm_file = open("/proc/{}/statm".format(pid))
+            rss = int(statm_file.read().split()[1]) * self.page_size
+            statm_file.close()
+        except (OSError, ValueError, IndexError):
+            return 0
+        return rss
+
+
+def create_analyzer_config(name, server, path):
+    analyzer_config = {"username": "benchmark", "password": "benchmark", "path": path}
+    if name == "bitbucket":
+        analyzer_config["workspace"] = "benchmark"
+        analyzer_config["api_url"] = server.url + "/"
+    else:
+        analyzer_config["url"] = server.url
+
+    # the settings given to every analyzer (e.g. the number of processes or the scan engine)
+    analyzer_config.update(config["analyzer_config"])
+
+    config_path = "{}{}.json".format(config["path"], name)
+    config_file = open(config_path, "w")
+    json.dump(analyzer_config, config_file, indent=4)
+    config_file.close()
+
+    return config_path
+
+
+def count_leaks(path):
+    # counts the results written by an analysis, from either the results database or the csv files
+    results_db_path = path + "results.sqlite"
+    if os.path.exists(results_db_path):
+        results_store = common.ResultsStore(results_db_path)
+        num_leaks = len(results_store.query(None, None, None))
+        results_store.close()
+        return num_leaks
+
+    num_leaks = 0
+    results_path = path + "results/"
+    if os.path.exists(results_path):
+        for filename in os.listdir(results_path):
+            if filename.endswith(".csv"):
+                num_leaks += len(common.deserialize_csv(results_path + filename))
+    return num_leaks
+
+
+def run_analyzer(name, server, num_documents, num_bytes, num_secrets):
+    path = "{}{}/".format(config["path"], name)
+    # every run is a full analysis, the previous outputs are removed
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    config_path = create_analyzer_config(name, server, path)
+    rss_path = "{}{}.rss".format(config["path"], name)
+    command = [sys.executable, "-c", measure_command, rss_path, sys.executable, "{}/{}_analyzer.py".format(repository_path, name), "-c", config_path]
+    if config["verbose"]:
+        command.append("-V")
+
+    logger.info("running the {} analyzer...".format(name))
+    num_requests = server.requests
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=repository_path)
+    # the intermediate process isn't part of the analyzer, only its descendants are sampled
+    memory_sampler = MemorySampler(process.pid, memory_sampling_interval)
+    memory_sampler.start()
+    process.wait()
+    elapsed = time.perf_counter() - start
+    memory_sampler.stop()
+
+    peak_rss = round(memory_sampler.peak_rss / 1024 / 1024, 1) if memory_sampler.peak_rss is not None else None
+    max_process_rss = None
+    if os.path.exists(rss_path):
+        rss_file = open(rss_path)
+        max_process_rss = round(int(rss_file.read()) / 1024, 1)
+        rss_file.close()
+        os.remove(rss_path)
+
+    if process.returncode != 0:
+        logger.error("the {} analyzer exited with code {}".format(name, process.returncode))
+
+    result = {"analyzer": name, "exit_code": process.returncode, "documents": num_documents, "bytes": num_bytes, "seconds": round(elapsed, 3),
+              "documents_per_second": round(num_documents / elapsed, 2) if elapsed else 0, "mb_per_second": round(num_bytes / elapsed / 1e6, 3) if elapsed else 0,
+              "peak_rss_mb": peak_rss, "max_process_rss_mb": max_process_rss, "requests": server.requests - num_requests,
+              "planted_secrets": num_secrets, "leaks_found": count_leaks(path)}
+
+    logger.info("{}: {} {} ({:.1f} MB) in {:.2f}s, {:.1f} {}/s, {:.2f} MB/s, peak rss: {} MB (largest process: {} MB), {} requests, {} planted secrets, {} leaks found"
+                .format(name, num_documents, analyzers[name], num_bytes / 1e6, elapsed, result["documents_per_second"], analyzers[name], result["mb_per_second"],
+                        result["peak_rss_mb"], result["max_process_rss_mb"], result["requests"], num_secrets, result["leaks_found"]))
+    return result
+
+
+def print_help():
+    logger.info("usage: {}.py [options...]".format(program_name))
+    logger.info("")
+    logger.info("generates a synthetic corpus, serves it through a mock of the atlassian apis and runs the analyzers against it")
+    logger.info("")
+    logger.info("options:")
+    logger.info("\t-c, --config       path of the config file to load (every option can be set through it)")
+    logger.info("\t-s, --save         saves the config to a file")
+    logger.info("\t-o, --output       path of the working directory (corpus, analyzer configs and outputs)")
+    logger.info("\t-a, --analyzers    comma-separated list of the analyzers to run (confluence, jira, bitbucket)")
+    logger.info("\t-S, --seed         seed of the generated corpus")
+    logger.info("\t-j, --processes    number of processes used by the analyzers")
+    logger.info("\t-r, --report       path of the json report of the load test")
+    logger.info("\t-V, --verbose      enables the debug logging mode (also for the analyzers)")
+    logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
+    logger.info("\t-h, --help         shows this help message and exits")
+    logger.info("\t-v, --version      shows the program's version and exits")
+
+
+def print_version():
+    logger.info("{} version: {}".format(program_name, program_version))
+
+
+def main(argv):
+    global config
+
+    save_config_path = ""
+    report_path = ""
+
+    try:
+        # getopt is used to define the list of options the program should accept
+        opts, args = getopt.getopt(argv, "c:s:o:a:S:j:r:Vl:hv", ["config=", "save=", "output=", "analyzers=", "seed=", "processes=", "report=", "verbose", "log=", "help",
+                                                                "version"])
+
+        filename = ""
+        use_debug_mode = False
+        for opt, arg in opts:
+            if opt in ("-V", "--verbose"):
+                use_debug_mode = True
+            elif opt in ("-l", "--log"):
+                filename = arg
+
+        # initializes the logging system
+        common.initialize_logger(use_debug_mode, filename)
+        config["verbose"] = use_debug_mode
+
+        # first, check for the config file because it has precedence over the other options
+        # additionally, help and version also have precedence as they will exit the program
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print_help()
+                sys.exit()
+            elif opt in ("-v", "--version"):
+                print_version()
+                sys.exit()
+            elif opt in ("-c", "--config"):
+                config_file = open(arg)
+                config.update(json.load(config_file))
+                config_file.close()
+
+        # then, check for all other options
+        for opt, arg in opts:
+            if opt in ("-s", "--save"):
+                save_config_path = arg
+            elif opt in ("-o", "--output"):
+                config["path"] = arg
+            elif opt in ("-a", "--analyzers"):
+                config["analyzers"] = [name.strip() for name in arg.split(",") if name.strip()]
+            elif opt in ("-S", "--seed"):
+                config["seed"] = arg
+            elif opt in ("-j", "--processes"):
+                if arg.isnumeric():
+                    config.setdefault("analyzer_config", {})["num_processes"] = int(arg)
+                else:
+                    logger.error("the number of processes must be a numeric value!")
+            elif opt in ("-r", "--report"):
+                report_path = arg
+
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(1)
+
+    # set default values for the options which do not exist
+    if "analyzers" not in config:
+        config["analyzers"] = list(analyzers)
+    if "seed" not in config:
+        config["seed"] = "benchmark"
+    # size of the corpus of each analyzer
+    if "num_spaces" not in config:
+        config["num_spaces"] = 10
+    if "pages_per_space" not in config:
+        config["pages_per_space"] = 100
+    if "num_projects" not in config:
+        config["num_projects"] = 10
+    if "issues_per_project" not in config:
+        config["issues_per_project"] = 100
+    # the issues with more comments than the ones embedded in a search need another request
+    if "comments_per_issue" not in config:
+        config["comments_per_issue"] = 8
+    if "num_repositories" not in config:
+        config["num_repositories"] = 10
+    if "files_per_repository" not in config:
+        config["files_per_repository"] = 100
+    if "words_per_document" not in config:
+        config["words_per_document"] = 500
+    # share of the documents containing a secret
+    if "secret_rate" not in config:
+        config["secret_rate"] = 0.05
+    # settings added to the config of every analyzer
+    if "analyzer_config" not in config:
+        config["analyzer_config"] = {}
+    if "path" not in config or not config["path"]:
+        config["path"] = "./load_test/"
+    elif not config["path"].endswith("/"):
+        config["path"] += "/"
+    config["path"] = os.path.abspath(config["path"]) + "/"
+
+    for name in config["analyzers"]:
+        if name not in analyzers:
+            logger.critical("unknown analyzer: {}".format(name))
+            sys.exit(1)
+
+    # saves the config if needed (the verbose mode is only an option of the program)
+    if save_config_path:
+        config_file = open(save_config_path, "w")
+        json.dump({key: value for key, value in config.items() if key != "verbose"}, config_file, indent=4)
+        config_file.close()
+        logger.info("saved config to: {}".format(save_config_path))
+
+    if not os.path.exists(config["path"]):
+        os.makedirs(config["path"])
+
+    corpus = corpus_module.Corpus(config)
+    repositories_path = config["path"] + "repositories/"
+    if "bitbucket" in config["analyzers"]:
+        logger.info("creating {} repositories...".format(config["num_repositories"]))
+        corpus.create_repositories(repositories_path)
+
+    num_documents = corpus.count_documents()
+    num_bytes = corpus.count_bytes()
+    num_secrets = corpus.count_secrets()
+
+    server = mock_atlassian.MockAtlassianServer(corpus, repositories_path)
+    server.start()
+    logger.info("mock server listening on: {}".format(server.url))
+
+    results = []
+    for name in config["analyzers"]:
+        results.append(run_analyzer(name, server, num_documents[name], num_bytes[name], num_secrets[name]))
+
+    server.stop()
+
+    if report_path:
+        report_file = open(report_path, "w")
+        json.dump({"config": {key: value for key, value in config.items() if key != "verbose"}, "results": results}, report_file, indent=4)
+        report_file.close()
+        logger.info("saved report to: {}".format(report_path))
+
+    # the load test fails if any analyzer has failed
+    if any(result["exit_code"] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
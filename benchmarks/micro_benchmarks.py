@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import re
+import sys
+import json
+import time
+import getopt
+import random
+import shutil
+import statistics
+import string
+import logging
+import platform
+import tempfile
+
+# the analyzers are next to the benchmarks directory
+repository_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_path)
+
+import common
+
+# the program's name
+program_name = "micro_benchmarks"
+# the program's version
+program_version = "1.0.0"
+# the logger to use throughout the program
+logger = logging.getLogger(program_name)
+
+# the baseline stored along with the benchmarks
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro_baseline.json")
+# minimum duration of a measure, the functions are called as many times as needed to reach it
+min_measure_time = 0.5
+# the slowest benchmarks are repeated less, until they have been measured for this long
+max_benchmark_time = 10
+# the generated reports and csv files are written in memory when possible, so the csv serialization isn't bound by the disk
+temporary_root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# configuration of the benchmarks (the sizes are numbers of findings)
+config = {"sizes": [10, 100, 1000, 10000, 100000], "num_filters": 200, "repeat": 7, "threshold": 0.25, "retries": 3, "seed": "benchmark"}
+
+
+def create_filters(num_filters):
+    # filters shaped like the ones of the analyzers' configs: file extensions and directories, placeholder secrets
+    if not num_filters:
+        return [], []
+
+    file_filters = [r"\.min\.js$", r"/node_modules/", r"(?i)/tests?/"] + [r"/vendor{}/".format(i) for i in range(max(num_filters // 2 - 3, 0))]
+    content_filters = [r"(?i)example", r"\$\{[A-Z_]+\}", r"x{8,}"] + [r"placeholder{}\b".format(i) for i in range(max(num_filters - num_filters // 2 - 3, 0))]
+    return [re.compile(pattern) for pattern in file_filters], [re.compile(pattern) for pattern in content_filters]
+
+
+def create_report(path, num_findings, seed):
+    # a gitleaks report of documents, a tenth of the findings is excluded by the filters
+    rng = random.Random("{}:{}".format(seed, num_findings))
+    findings = []
+
+    for i in range(num_findings):
+        secret = "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(rng.randrange(16, 64)))
+        directory = "vendor{}".format(rng.randrange(50)) if i % 20 == 0 else "src"
+        match = "password = \"{}\"".format("placeholder{}".format(rng.randrange(50)) if i % 20 == 1 else secret)
+        file = "/tmp/analysis/downloads/{}/DOC-{}.html".format(directory, i // 3)
+
+        findings.append({"Description": "Generic API Key", "StartLine": rng.randrange(1, 2000), "EndLine": 0, "StartColumn": 1, "EndColumn": len(match), "Match": match,
+                         "Secret": secret, "File": file, "SymlinkFile": "", "Commit": "", "Entropy": round(rng.uniform(3, 5), 6), "Author": "", "Email": "",
+                         "Date": "", "Message": "", "Tags": [], "RuleID": "generic-api-key", "Fingerprint": "{}:generic-api-key:{}".format(file, i)})
+
+    report_file = open(path, "w")
+    json.dump(findings, report_file, indent=1)
+    report_file.close()
+
+
+def calibrate():
+    # work shaped like the benchmarks (parsing, regexes, objects and string formatting) measuring the speed of the machine,
+    # it allocates as much as the mid-sized benchmarks so it is slowed down by the same contention
+    rng = random.Random(config["seed"])
+    report = json.dumps([{"Match": "".join(rng.choice(string.ascii_letters) for _ in range(32)), "File": "src/{}.py".format(i), "StartLine": i} for i in range(5000)])
+    pattern = re.compile(r"[A-Z]{3}")
+
+    def work():
+        csv = []
+        for finding in json.loads(report):
+            if pattern.search(finding["Match"]):
+                csv.append(common.LeakCsv(finding["File"], str(finding["StartLine"]), finding["Match"], ""))
+        return ["{} ;{} ;{}".format(line.file, line.line, line.secret) for line in csv]
+
+    return measure(work)
+
+
+def measure(function):
+    # returns the duration of a call, the best of the repeats is kept as it is the least disturbed by the system
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_measure_time:
+            break
+        number *= 10 if elapsed < min_measure_time / 10 else 2
+
+    durations = [elapsed / number]
+    total = elapsed
+    for _ in range(config["repeat"] - 1):
+        if total >= max_benchmark_time:
+            break
+
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        durations.append(elapsed / number)
+        total += elapsed
+
+    return min(durations)
+
+
+def create_benchmarks(path, size):
+    # the benchmarks of a size in the order they are run (the csv file is written before being read), they are kept to be
+    # measured again
+    benchmarks = []
+    report_path = "{}report-{}.log".format(path, size)
+    csv_path = "{}report-{}.csv".format(path, size)
+    create_report(report_path, size, config["seed"])
+
+    for num_filters in sorted({0, config["num_filters"]}):
+        file_filters_re, content_filters_re = create_filters(num_filters)
+        benchmarks.append(("deserialize_gitleaks/{}/filters={}".format(size, num_filters),
+                           lambda file_filters_re=file_filters_re, content_filters_re=content_filters_re: common.deserialize_gitleaks(report_path, file_filters_re,
+                                                                                                                                   content_filters_re)))
+
+    leaks = common.deserialize_gitleaks(report_path, [], [])
+    csv = common.gitleaks_to_csv(leaks, "DOC")
+    benchmarks.append(("gitleaks_to_csv/{}".format(size), lambda: common.gitleaks_to_csv(leaks, "DOC")))
+    benchmarks.append(("serialize_csv/{}".format(size), lambda: common.serialize_csv(csv_path, csv, "https://example.com/DOC/")))
+    benchmarks.append(("deserialize_csv/{}".format(size), lambda: common.deserialize_csv(csv_path)))
+
+    return benchmarks
+
+
+def run_benchmarks(path):
+    # the calibration is measured along each size, its median follows the speed of the machine over the whole run
+    benchmarks = {}
+    results = {}
+    calibrations = []
+
+    for size in config["sizes"]:
+        calibrations.append(calibrate())
+        logger.debug("calibration: {:.6f}s".format(calibrations[-1]))
+
+        for name, function in create_benchmarks(path, size):
+            benchmarks[name] = function
+            results[name] = measure(function)
+            logger.info("{}: {:.6f}s".format(name, results[name]))
+
+    calibrations.append(calibrate())
+    calibration = statistics.median(calibrations)
+    logger.info("calibration: {:.6f}s".format(calibration))
+    return benchmarks, results, calibration
+
+
+def compare_results(results, speed, baseline):
+    # a benchmark regresses when it is slower than the baseline by more than the threshold
+    regressions = []
+
+    for name, duration in results.items():
+        if name not in baseline["results"]:
+            logger.info("{}: {:.6f}s (not in the baseline)".format(name, duration))
+            continue
+
+        ratio = duration * speed / baseline["results"][name]
+        if ratio > 1 + config["threshold"]:
+            regressions.append(name)
+            logger.warning("{}: {:.6f}s, {:.2f}x the baseline ({:.6f}s)".format(name, duration, ratio, baseline["results"][name]))
+        else:
+            logger.info("{}: {:.6f}s, {:.2f}x the baseline ({:.6f}s)".format(name, duration, ratio, baseline["results"][name]))
+
+    if regressions:
+        logger.warning("{} benchmarks regressed by more than {:.0f}%".format(len(regressions), config["threshold"] * 100))
+    else:
+        logger.info("no benchmark regressed by more than {:.0f}%".format(config["threshold"] * 100))
+
+    return regressions
+
+
+def get_speed(calibration, baseline):
+    speed = baseline["calibration"] / calibration if baseline.get("calibration") else 1
+    logger.info("the machine runs at {:.2f}x the baseline's speed".format(speed))
+    # the calibration only excuses a machine slower than the baseline's one, it never makes the check stricter
+    return min(speed, 1)
+
+
+def check_results(benchmarks, results, calibration, baseline):
+    # a benchmark slower than the threshold is measured again before being reported, only a slowdown which persists is
+    # a regression (the best measure is kept in the results)
+    regressions = compare_results(results, get_speed(calibration, baseline), baseline)
+
+    for _ in range(config["retries"]):
+        if not regressions:
+            break
+
+        # the machine may have slowed down since the benchmarks were run, its speed is measured again along them
+        logger.info("measuring {} benchmarks again...".format(len(regressions)))
+        speed = get_speed(calibrate(), baseline)
+        durations = {name: measure(benchmarks[name]) for name in regressions}
+        for name, duration in durations.items():
+            results[name] = min(results[name], duration)
+        regressions = compare_results(durations, speed, baseline)
+
+    return regressions
+
+
+def print_help():
+    logger.info("usage: {}.py [options...]".format(program_name))
+    logger.info("")
+    logger.info("measures the parsing and serialization functions of common.py on generated gitleaks reports and csv files, and compares them to a baseline")
+    logger.info("")
+    logger.info("options:")
+    logger.info("\t-b, --baseline     path of the baseline (default: benchmarks/micro_baseline.json)")
+    logger.info("\t-s, --save         saves the results as the new baseline instead of comparing them")
+    logger.info("\t-S, --sizes        comma-separated list of the numbers of findings (default: 10,100,1000,10000,100000)")
+    logger.info("\t-f, --filters      number of file and content filters of the filtered benchmarks (default: 200)")
+    logger.info("\t-r, --repeat       number of measures of each benchmark, the best one is kept (default: 7)")
+    logger.info("\t-t, --threshold    slowdown from the baseline reported as a regression, in percent (default: 25)")
+    logger.info("\t-R, --retries      number of times a regressed benchmark is measured again before being reported (default: 3)")
+    logger.info("\t-o, --output       path of a json file in which the results will be saved")
+    logger.info("\t-V, --verbose      enables the debug logging mode")
+    logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
+    logger.info("\t-h, --help         shows this help message and exits")
+    logger.info("\t-v, --version      shows the program's version and exits")
+
+
+def print_version():
+    logger.info("{} version: {}".format(program_name, program_version))
+
+
+def main(argv):
+    baseline_path = default_baseline_path
+    output_path = ""
+    save_baseline = False
+
+    try:
+        # getopt is used to define the list of options the program should accept
+        opts, args = getopt.getopt(argv, "b:sS:f:r:t:R:o:Vl:hv", ["baseline=", "save", "sizes=", "filters=", "repeat=", "threshold=", "retries=", "output=", "verbose", "log=",
+                                                                 "help", "version"])
+
+        filename = ""
+        use_debug_mode = False
+        for opt, arg in opts:
+            if opt in ("-V", "--verbose"):
+                use_debug_mode = True
+            elif opt in ("-l", "--log"):
+                filename = arg
+
+        # initializes the logging system
+        common.initialize_logger(use_debug_mode, filename)
+
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print_help()
+                sys.exit()
+            elif opt in ("-v", "--version"):
+                print_version()
+                sys.exit()
+            elif opt in ("-b", "--baseline"):
+                baseline_path = arg
+            elif opt in ("-s", "--save"):
+                save_baseline = True
+            elif opt in ("-S", "--sizes"):
+                config["sizes"] = [int(size) for size in arg.split(",") if size.strip().isnumeric()]
+            elif opt in ("-f", "--filters"):
+                if arg.isnumeric():
+                    config["num_filters"] = int(arg)
+                else:
+                    logger.error("the number of filters must be a numeric value!")
+            elif opt in ("-r", "--repeat"):
+                if arg.isnumeric() and int(arg) > 0:
+                    config["repeat"] = int(arg)
+                else:
+                    logger.error("the number of repeats must be a positive numeric value!")
+            elif opt in ("-t", "--threshold"):
+                if arg.isnumeric():
+                    config["threshold"] = int(arg) / 100
+                else:
+                    logger.error("the threshold must be a numeric value!")
+            elif opt in ("-R", "--retries"):
+                if arg.isnumeric():
+                    config["retries"] = int(arg)
+                else:
+                    logger.error("the number of retries must be a numeric value!")
+            elif opt in ("-o", "--output"):
+                output_path = arg
+
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(1)
+
+    baseline = None
+    if not save_baseline and os.path.exists(baseline_path):
+        baseline_file = open(baseline_path)
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+
+    # the generated reports and csv files are removed once measured
+    path = tempfile.mkdtemp(prefix="micro_benchmarks_", dir=temporary_root) + "/"
+    try:
+        benchmarks, results, calibration = run_benchmarks(path)
+
+        # the regressed benchmarks are measured again while their files still exist
+        regressions = check_results(benchmarks, results, calibration, baseline) if baseline else []
+    finally:
+        shutil.rmtree(path)
+
+    run = {"python": platform.python_version(), "machine": platform.machine(), "config": config, "calibration": calibration, "results": results}
+
+    if output_path:
+        output_file = open(output_path, "w")
+        json.dump(run, output_file, indent=4)
+        output_file.close()
+        logger.info("saved results to: {}".format(output_path))
+
+    if save_baseline:
+        baseline_file = open(baseline_path, "w")
+        json.dump(run, baseline_file, indent=4)
+        baseline_file.close()
+        logger.info("saved baseline to: {}".format(baseline_path))
+        return
+
+    if not baseline:
+        logger.warning("no baseline found, run with --save to create it: {}".format(baseline_path))
+        return
+
+    # the benchmarks regressed, the program fails (e.g. to be used in a ci)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,174 @@
+# coding: utf-8
+
+import re
+import json
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("mock_atlassian")
+
+# number of repositories per page of the bitbucket api
+bitbucket_page_length = 10
+# number of comments embedded in the issues returned by a jira search (the others need another request)
+jira_embedded_comments = 5
+
+
+class MockAtlassianHandler(BaseHTTPRequestHandler):
+    # serves the endpoints of confluence, jira and bitbucket (as called by atlassian-python-api) from the documents of a
+    # corpus, every response is generated when it is requested
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.rstrip("/")
+
+        for pattern, route in self.server.routes:
+            match = pattern.fullmatch(path)
+            if match:
+                response = route(self.server, params, *match.groups())
+                break
+        else:
+            response = None
+
+        if response is None:
+            self.send_error(404)
+            return
+
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        self.server.count_request()
+
+
+def get_range(params, start_name, limit_name, total, default_limit=25):
+    start = int(params.get(start_name, 0))
+    limit = int(params.get(limit_name, default_limit))
+    return range(min(start, total), min(start + limit, total))
+
+
+def get_spaces(server, params):
+    corpus = server.corpus
+    return {"results": [{"key": corpus.get_space_key(space), "name": "Space {}".format(space), "type": "global"} for space in range(corpus.num_spaces)]}
+
+
+def get_space_pages(server, params):
+    corpus = server.corpus
+    key = params.get("spaceKey", "")
+    spaces = [space for space in range(corpus.num_spaces) if corpus.get_space_key(space) == key]
+    if not spaces:
+        return {"results": []}
+
+    return {"results": [corpus.get_page(spaces[0], page) for page in get_range(params, "start", "limit", corpus.pages_per_space)]}
+
+
+def search_pages(server, params):
+    # every page has the same modification date, a search always returns all the pages of the space
+    match = re.search(r'space = "([^"]+)"', params.get("cql", ""))
+    if not match:
+        return {"results": []}
+
+    pages = get_space_pages(server, {"spaceKey": match.group(1), "start": params.get("start", 0), "limit": params.get("limit", 25)})
+    return {"results": [{"content": page} for page in pages["results"]]}
+
+
+def get_page(server, params, page_id):
+    corpus = server.corpus
+    space, page = corpus.get_page_location(page_id)
+    if space >= corpus.num_spaces:
+        return None
+
+    return corpus.get_page(space, page)
+
+
+def get_projects(server, params):
+    corpus = server.corpus
+    return {"values": [{"id": str(project + 1), "key": corpus.get_project_key(project), "name": "Project {}".format(project)} for project in range(corpus.num_projects)],
+            "isLast": True}
+
+
+def search_issues(server, params):
+    corpus = server.corpus
+    match = re.search(r'project = "([^"]+)"', params.get("jql", ""))
+    projects = [project for project in range(corpus.num_projects) if match and corpus.get_project_key(project) == match.group(1)]
+    if not projects:
+        return {"issues": [], "total": 0}
+
+    issues = get_range(params, "startAt", "maxResults", corpus.issues_per_project, 50)
+    return {"issues": [corpus.get_issue(projects[0], issue, jira_embedded_comments) for issue in issues], "startAt": issues.start, "maxResults": len(issues),
+            "total": corpus.issues_per_project}
+
+
+def get_issue_comments(server, params, project_key, issue_number):
+    corpus = server.corpus
+    projects = [project for project in range(corpus.num_projects) if corpus.get_project_key(project) == project_key]
+    issue = int(issue_number) - 1
+    if not projects or not 0 <= issue < corpus.issues_per_project:
+        return None
+
+    comments = get_range(params, "startAt", "maxResults", corpus.comments_per_issue, 50)
+    return {"comments": [corpus.get_comment(projects[0], issue, comment) for comment in comments], "startAt": comments.start, "maxResults": len(comments),
+            "total": corpus.comments_per_issue}
+
+
+def get_workspace(server, params, workspace):
+    base_url = "{}/2.0/".format(server.url)
+    return {"type": "workspace", "slug": workspace, "name": workspace, "uuid": "{00000000-0000-0000-0000-000000000000}",
+            "links": {"self": {"href": base_url + "workspaces/" + workspace}, "repositories": {"href": base_url + "repositories/" + workspace},
+                      "projects": {"href": base_url + "workspaces/" + workspace + "/projects"}, "members": {"href": base_url + "workspaces/" + workspace + "/members"}}}
+
+
+def get_repositories(server, params, workspace):
+    corpus = server.corpus
+    page = int(params.get("page", 1))
+    repositories = range((page - 1) * bitbucket_page_length, min(page * bitbucket_page_length, corpus.num_repositories))
+
+    response = {"values": [corpus.get_repository(repository, server.repositories_path) for repository in repositories], "page": page, "pagelen": bitbucket_page_length,
+                "size": corpus.num_repositories}
+    if repositories.stop < corpus.num_repositories:
+        response["next"] = "{}/2.0/repositories/{}?page={}".format(server.url, workspace, page + 1)
+    return response
+
+
+class MockAtlassianServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, corpus, repositories_path, address=("127.0.0.1", 0)):
+        super().__init__(address, MockAtlassianHandler)
+        self.corpus = corpus
+        self.repositories_path = repositories_path
+        self.url = "http://{}:{}".format(*self.server_address[:2])
+        self.routes = [(re.compile(r"/wiki/rest/api/space"), get_spaces),
+                       (re.compile(r"/wiki/rest/api/content"), get_space_pages),
+                       (re.compile(r"/wiki/rest/api/search"), search_pages),
+                       (re.compile(r"/wiki/rest/api/content/(\d+)"), get_page),
+                       (re.compile(r"/rest/api/2/project/search"), get_projects),
+                       (re.compile(r"/rest/api/2/search"), search_issues),
+                       (re.compile(r"/rest/api/2/issue/([A-Z][A-Z0-9]*)-(\d+)/comment"), get_issue_comments),
+                       (re.compile(r"/2.0/workspaces/([^/]+)"), get_workspace),
+                       (re.compile(r"/2.0/repositories/([^/]+)"), get_repositories)]
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        self.thread = None
+
+    def count_request(self):
+        with self.requests_lock:
+            self.requests += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -11,7 +11,8 @@ import os.path
 import logging
 import datetime
 import multiprocessing
-from git import Repo
+import concurrent.futures
+from git import Repo, GitCommandError
 from queue import Queue
 from threading import Thread
 from atlassian.bitbucket import Cloud
@@ -28,73 +29,185 @@ logger = logging.getLogger(program_name)
 file_filters_re = []
 # the compiled regex of content filters
 content_filters_re = []
+# the context given to every analysis
+scan_context = None
+# the pipeline handing the cloned repositories over to the analysis processes
+pipeline = None
+# logs the progress of the analysis at regular intervals
+progress = None
+# the state of the previous analyses (used to skip the repositories which haven't been updated)
+state = {}
 
 
 class AnalysisWorker(Thread):
     def __init__(self, queue, unique_id):
-        Thread.__init__(self)
+        Thread.__init__(self, name="worker-{}".format(unique_id))
         self.queue = queue
         self.unique_id = unique_id
 
     def run(self):
         while True:
             # gets a task if there are any (which contains an ssh url to the repo)
-            (url, name, clones_path, results_path, gitleaks_results_path) = self.queue.get()
+            (url, name, updated_on, clones_path, results_path, gitleaks_results_path, staging_path) = self.queue.get()
 
-            # gets the name of the repo from the url
-            clone_path = os.path.abspath(clones_path + name) + "/"
+            progress.start_task(name)
+            try:
+                self.download_repository(url, name, updated_on, clones_path, results_path, gitleaks_results_path, staging_path)
+            except Exception as e:
+                # the repository will be analyzed again by the next analysis, the thread goes on with the next one
+                pipeline.on_failure(name, e)
+            finally:
+                progress.finish_task(name)
 
+                # notify the queue handler that the task is done
+                self.queue.task_done()
+
+    def download_repository(self, url, name, updated_on, clones_path, results_path, gitleaks_results_path, staging_path):
+        # gets the name of the repo from the url
+        clone_path = os.path.abspath(clones_path + name) + "/"
+
+        with pipeline.measure("fetch", name):
             if not os.path.exists(clone_path):
-                # clone the repo
-                Repo.clone_from(url, clone_path)
+                # clone the repo (by default, only the last commit of the main branch is needed by gitleaks)
+                Repo.clone_from(url, clone_path, **get_clone_options())
             else:
-                # pull the changes
+                # fetch the changes and move to the new head of the remote branch (a pull would need to merge with the
+                # local history, which a shallow clone doesn't have)
                 try:
                     if not config["do_not_update_git"]:
                         repo = Repo(clone_path)
-                        repo.git.reset("--hard")
-                        repo.remotes.origin.pull()
+                        repo.remotes.origin.fetch(**get_fetch_options(clone_path))
+                        repo.git.reset("--hard", "@{u}")
                 except:
                     logger.error("couldn't pull the changes of the repository: {}".format(name))
+                    # the repository will be updated again by the next analysis
+                    updated_on = None
+
+        # the analyses of the files and of the history have their own results, as they don't find the same leaks
+        log_file_path = "{}{}{}.log".format(gitleaks_results_path, name, get_results_suffix())
+
+        try:
+            head = Repo(clone_path).head.commit.hexsha
+        except ValueError:
+            # the repository doesn't have any commit yet
+            head = None
+
+        last_head = get_last_analyzed_head(name)
+        processed_log_file_path = "{}{}{}.csv".format(results_path, name, get_results_suffix())
+
+        # the repository has been updated without any new commit on the analyzed branch
+        if head and last_head == head:
+            logger.debug("skipping repository without new commits: {}".format(name))
+        elif config["scan_history"]:
+            # the last analyzed commit may have disappeared from the history (e.g. after a force push), the whole
+            # history is analyzed again in that case
+            if last_head:
+                try:
+                    Repo(clone_path).git.cat_file("-e", last_head + "^{commit}")
+                except GitCommandError:
+                    logger.warning("the last analyzed commit of the repository is gone, analyzing its whole history: {}".format(name))
+                    last_head = None
+
+            shards = common.get_history_shards(clone_path, last_head, config["shard_commits"]) if head and config["shard_commits"] else []
+
+            # only the commits added since the last analysis are analyzed, their findings are merged into the results
+            if shards:
+                logger.info("analyzing the history of the repository in {} shards: {}".format(len(shards), name))
+                analyze_shards(name, log_file_path, [(common.analyze_history_shard, clone_path, log_opts) for log_opts in shards],
+                               common.merge_repository_history_shards, scan_context, name, log_file_path, processed_log_file_path, last_head)
+            elif head:
+                pipeline.submit(name, common.analyze_repository_history, scan_context, name, clone_path, log_file_path, processed_log_file_path, last_head)
+        elif not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
+            shards = common.get_repository_shards(clone_path, config["shard_size"] * 1024 * 1024) if config["shard_size"] else []
+
+            # the oversized repositories are split so that a single analysis doesn't hold the others back (unless
+            # their findings are already cached)
+            if shards and not is_cached(head, clone_path):
+                logger.info("analyzing the repository in {} shards: {}".format(len(shards), name))
+                analyze_shards(name, log_file_path, [(common.analyze_repository_shard, scan_context, clone_path, files, staging_path) for files in shards],
+                               common.merge_repository_shards, scan_context, name, clone_path, log_file_path, processed_log_file_path, head)
+            else:
+                # hands the repository over to the analysis processes (the cached findings of a repository are
+                # indexed by its current commit)
+                pipeline.submit(name, common.analyze_repository, scan_context, name, clone_path, log_file_path, processed_log_file_path, head)
+
+        # the next analysis will skip the repository if it hasn't been updated, the state of the other mode is kept (the
+        # previous state is copied as it is restored if the analysis fails)
+        repository_state = dict(state["repositories"].get(name, {}))
+        prefix = get_state_prefix()
+        repository_state[prefix + "updated_on"] = updated_on
+        repository_state[prefix + "head"] = head
+        repository_state[prefix + "analysis"] = scan_context.analysis_hash
+        state["repositories"][name] = repository_state
+
+
+def analyze_shards(name, log_file_path, shards, merge_function, *merge_args):
+    report_paths = []
+    futures = []
+
+    # every shard is analyzed by its own process, their reports are merged once all of them are done
+    for i, (function, *args) in enumerate(shards):
+        report_path = "{}.{}".format(log_file_path, i)
+        report_paths.append(report_path)
+        futures.append(pipeline.submit(name, function, *args, report_path))
+
+    concurrent.futures.wait(futures)
+
+    # the failure of a shard has already been reported, the repository will be analyzed again by the next analysis
+    if all(future.exception() is None for future in futures):
+        pipeline.submit(name, merge_function, *merge_args, report_paths)
+
+
+def is_cached(cache_key, clone_path):
+    scan_cache = scan_context.get_scan_cache()
+    return bool(scan_cache and cache_key and scan_cache.get(cache_key, clone_path) is not None)
+
+
+def get_state_prefix():
+    # the analyses of the files and of the history are tracked separately
+    return "history_" if config["scan_history"] else ""
+
+
+def get_results_suffix():
+    return ".history" if config["scan_history"] else ""
 
-            log_file_path = "{}{}.log".format(gitleaks_results_path, name)
 
-            if not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
-                # checks for leak using gitleaks and store the logs in a stream
-                gitleaks_logs = common.run_gitleaks(clone_path)
+def get_last_analyzed_head(name):
+    repository_state = state["repositories"].get(name)
+    prefix = get_state_prefix()
 
-                # if the logs are not empty, save them in a file
-                # else, remove the file (we have fixed all the leaks)
-                if gitleaks_logs:
-                    log_file = open(log_file_path, "w")
-                    log_file.write(gitleaks_logs)
-                    log_file.close()
-                elif os.path.exists(log_file_path):
-                    os.path.realpath(log_file_path)
+    # the previous analysis is only reused if it was made with the same rules and filters
+    if not repository_state or repository_state.get(prefix + "analysis") != scan_context.analysis_hash:
+        return None
 
-                # deserialize the gitleaks logs
-                leaks = common.deserialize_gitleaks(log_file_path, file_filters_re, content_filters_re)
+    return repository_state.get(prefix + "head")
 
-                # defines the path of the processed csv file
-                processed_log_file_path = "{}{}.csv".format(results_path, name)
 
-                # convert from gitleaks format to csv format
-                csv = common.gitleaks_to_csv(leaks, name)
+def get_clone_options():
+    options = {}
 
-                # load the last generated csv file if it exists to export the comments to te new one
-                old_csv = common.deserialize_csv(processed_log_file_path)
-                for line in csv:
-                    for old_line in old_csv:
-                        # if it seems to be the same secret in the same file, we assume they should have the same comment
-                        if old_line.comment and line.secret == old_line.secret and line.file == old_line.file:
-                            line.comment = old_line.comment
-                            break
+    # the whole history is needed to analyze the commits
+    if config["clone_depth"] > 0 and not config["scan_history"]:
+        options["depth"] = config["clone_depth"]
+    if config["clone_filter"]:
+        options["filter"] = config["clone_filter"]
+    if config["clone_single_branch"]:
+        options["single_branch"] = True
 
-                # serialize the csv into a file
-                common.serialize_csv(processed_log_file_path, csv)
+    return options
 
-            # notify the queue handler that the task is done
-            self.queue.task_done()
+
+def get_fetch_options(clone_path):
+    options = {}
+
+    if config["scan_history"]:
+        # the clones made without history mode need their whole history to be fetched
+        if os.path.exists(clone_path + ".git/shallow"):
+            options["unshallow"] = True
+    elif config["clone_depth"] > 0:
+        options["depth"] = config["clone_depth"]
+
+    return options
 
 
 def print_help():
@@ -110,7 +223,11 @@ def print_help():
     logger.info("\t-u, --username     username of your atlassian account")
     logger.info("\t-p, --password     password (or application password for maximum security) of your atlassian account")
     logger.info("\t-o, --output       output path that will be used for cloning and analyzing")
-    logger.info("\t-t, --threads      number of threads to use for parallel analysis")
+    logger.info("\t-t, --threads      number of threads to use for parallel cloning")
+    logger.info("\t-j, --processes    number of processes to use for parallel analysis (0 analyzes within the cloning threads)")
+    logger.info("\t-H, --history      analyzes the commits added since the last analysis instead of the files")
+    logger.info("\t    --profile      profiles every thread and process of the analysis (saved as profile.pstats and profile.collapsed)")
+    logger.info("\t    --sampling     profiles by sampling the stacks instead, with a low overhead")
     logger.info("\t-V, --verbose      enables the debug logging mode")
     logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
     logger.info("\t-h, --help         shows this help message and exits")
@@ -122,7 +239,7 @@ def print_version():
 
 
 def main(argv):
-    global config, file_filters_re, content_filters_re
+    global config, file_filters_re, content_filters_re, scan_context, pipeline, progress, state
 
     save_config_path = ""
 
@@ -132,7 +249,8 @@ def main(argv):
 
     try:
         # getopt is used to define the list of options the program should accept
-        opts, args = getopt.getopt(argv, "c:s:w:u:p:o:t:Vl:hv", ["config=", "save=", "workspace=", "username=", "password=", "output=", "threads=", "verbose", "log=", "help", "version"])
+        opts, args = getopt.getopt(argv, "c:s:w:u:p:o:t:j:HVl:hv", ["config=", "save=", "workspace=", "username=", "password=", "output=", "threads=", "processes=", "history",
+                                                                   "profile", "sampling", "verbose", "log=", "help", "version"])
 
         filename = ""
         use_debug_mode = False
@@ -176,6 +294,17 @@ def main(argv):
                     config["num_threads"] = int(arg)
                 else:
                     logger.error("the number of threads must be a numeric value!")
+            elif opt in ("-j", "--processes"):
+                if arg.isnumeric():
+                    config["num_processes"] = int(arg)
+                else:
+                    logger.error("the number of processes must be a numeric value!")
+            elif opt == "--profile":
+                config["profile"] = "cprofile"
+            elif opt == "--sampling":
+                config["profile"] = "sampling"
+            elif opt in ("-H", "--history"):
+                config["scan_history"] = True
 
         # checks if the necessary settings have been provided
         if ("workspace" not in config or not config["workspace"]) or \
@@ -193,6 +322,28 @@ def main(argv):
         config["do_not_renew_analysis"] = False
     if "do_not_update_git" not in config:
         config["do_not_update_git"] = False
+    # analyzes the history of the repositories (the commits added since the last analysis) instead of their files
+    if "scan_history" not in config:
+        config["scan_history"] = False
+    # size (in MiB) of the files above which a repository is split into shards analyzed in parallel (0 disables it)
+    if "shard_size" not in config or not isinstance(config["shard_size"], int) or config["shard_size"] < 0:
+        config["shard_size"] = 256
+    # same for the number of commits to analyze in history mode
+    if "shard_commits" not in config or not isinstance(config["shard_commits"], int) or config["shard_commits"] < 0:
+        config["shard_commits"] = 1000
+    # url of bitbucket's api (e.g. a local server to benchmark the analyzer)
+    if "api_url" not in config or not config["api_url"]:
+        config["api_url"] = "https://api.bitbucket.org/"
+    # number of commits to clone (0 clones the whole history, gitleaks only analyzes the last one)
+    if "clone_depth" not in config or not isinstance(config["clone_depth"], int) or config["clone_depth"] < 0:
+        config["clone_depth"] = 1
+    # partial clone filter (e.g. "blob:none" only downloads the files of the commits that are checked out)
+    if "clone_filter" not in config:
+        config["clone_filter"] = ""
+    # only clones the main branch
+    if "clone_single_branch" not in config:
+        config["clone_single_branch"] = True
+    # the repositories to analyze or exclude, by key (either glob patterns, or regex patterns prefixed by "re:")
     if "whitelist" not in config:
         config["whitelist"] = []
     if "blacklist" not in config:
@@ -201,23 +352,75 @@ def main(argv):
         config["file_filters"] = []
     if "content_filters" not in config:
         config["content_filters"] = []
+    if "do_not_use_cache" not in config:
+        config["do_not_use_cache"] = False
+    # engine analyzing the sources: "gitleaks" runs gitleaks, "python" analyzes them within the analysis processes with
+    # the rules of gitleaks' configuration (the history mode always runs gitleaks)
+    if "scan_engine" not in config or config["scan_engine"] not in ("gitleaks", "python"):
+        config["scan_engine"] = "gitleaks"
+    # the default rules of gitleaks used by the python engine (downloaded for the installed version of gitleaks if none)
+    if "default_rules_path" not in config:
+        config["default_rules_path"] = ""
+    # stores the results in a single database instead of a csv file per source (see results_db.py to query or export them)
+    if "use_results_db" not in config:
+        config["use_results_db"] = False
+    # maximum number of analyses kept in the cache (the least recently used are evicted first)
+    if "cache_max_entries" not in config:
+        config["cache_max_entries"] = 1000000
     # find the number of thread to use for the multithreading if none is defined (by default, the number of cpu cores
     # for maximum profitability)
-    if "num_threads" not in config or not config["num_threads"].isnumeric() or config["num_threads"] <= 0:
+    if "num_threads" not in config or not isinstance(config["num_threads"], int) or config["num_threads"] <= 0:
         config["num_threads"] = multiprocessing.cpu_count()
+    # maximum number of concurrent requests to the server (the actual number adapts to the server's load)
+    if "max_connections" not in config or not isinstance(config["max_connections"], int) or config["max_connections"] <= 0:
+        config["max_connections"] = 16
+    # same for the number of processes running the analyses
+    if "num_processes" not in config or not isinstance(config["num_processes"], int) or config["num_processes"] < 0:
+        config["num_processes"] = multiprocessing.cpu_count()
+    # number of analyses which can wait for a process before the cloning is paused
+    if "max_pending_scans" not in config or not isinstance(config["max_pending_scans"], int) or config["max_pending_scans"] <= 0:
+        config["max_pending_scans"] = 2 * max(config["num_processes"], 1)
     # if no output path was specified, use a predefined value (e.g. "./workspace_2022-11-14_15-19-23/")
     if "path" not in config or not config["path"]:
         config["path"] = "./{}_{}/".format(config["workspace"], datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
     elif not config["path"].endswith("/"):
         config["path"] += "/"
+    # the cache is kept within the output path by default, it can be shared between outputs
+    if "cache_path" not in config or not config["cache_path"]:
+        config["cache_path"] = config["path"] + "cache.sqlite"
+    if "results_db_path" not in config or not config["results_db_path"]:
+        config["results_db_path"] = config["path"] + "results.sqlite"
+    # the json report of the analysis: time spent in each stage (histograms), by source and by worker
+    if "run_report_path" not in config or not config["run_report_path"]:
+        config["run_report_path"] = config["path"] + "run_report.json"
+    # exposes the metrics of a long analysis in the prometheus text format, through a file rewritten every
+    # `metrics_interval` seconds and/or an http endpoint (0 to disable it)
+    if "metrics_path" not in config:
+        config["metrics_path"] = ""
+    if "metrics_port" not in config or not isinstance(config["metrics_port"], int) or config["metrics_port"] < 0:
+        config["metrics_port"] = 0
+    # profiles the analysis: "cprofile" (deterministic) or "sampling" (the stacks of every thread are sampled every
+    # `profile_interval` seconds), the profiles of every thread and process are merged in the output path
+    if "profile" not in config or config["profile"] not in ("cprofile", "sampling"):
+        config["profile"] = ""
+    if "profile_interval" not in config or not isinstance(config["profile_interval"], (int, float)) or config["profile_interval"] <= 0:
+        config["profile_interval"] = 0.01
+    if "metrics_interval" not in config or not isinstance(config["metrics_interval"], (int, float)) or config["metrics_interval"] <= 0:
+        config["metrics_interval"] = 15
+    # logs the repositories done, an eta and the slowest repository every `progress_interval` seconds (0 to disable it)
+    if "progress_interval" not in config or not isinstance(config["progress_interval"], (int, float)) or config["progress_interval"] < 0:
+        config["progress_interval"] = 60
     # defines the path in which the analysis results will take place
     results_path = config["path"] + "results/"
     gitleaks_results_path = config["path"] + "gitleaks/"
     clones_path = config["path"] + "clones/"
+    # the shards of a repository are linked next to the clones (hard links need the same file system)
+    staging_path = config["path"] + "shards/"
+    state_path = config["path"] + "state.json"
 
     # connecting  to Atlassian account (either through account password or application password)
     logger.debug("connecting to account...")
-    account = Cloud(username=config["username"], password=config["password"])
+    account = Cloud(url=config["api_url"], username=config["username"], password=config["password"], session=common.create_session(config["max_connections"]))
     logger.info("connected to account: {}".format(config["username"]))
 
     # loading a given workspace
@@ -236,17 +439,63 @@ def main(argv):
     # creates the directory in which the clones will be if it doesn't exist
     if not os.path.exists(clones_path):
         os.mkdir(clones_path)
+    if not os.path.exists(staging_path):
+        os.mkdir(staging_path)
 
     logger.debug("compiling regex filters...")
+    whitelist_re = common.compile_source_patterns(config["whitelist"])
+    blacklist_re = common.compile_source_patterns(config["blacklist"])
     for file_filter in config["file_filters"]:
         file_filters_re.append(re.compile(file_filter))
     for content_filter in config["content_filters"]:
         content_filters_re.append(re.compile(content_filter))
 
+    default_rules_path = config["default_rules_path"]
+    if config["scan_engine"] == "python":
+        try:
+            default_rules_path = common.load_engine_rules(default_rules_path, config["path"])
+        except Exception as e:
+            logger.critical("couldn't load the rules of the python engine: {}".format(e))
+            sys.exit(1)
+
+    scan_context = common.ScanContext(file_filters_re, content_filters_re, "" if config["do_not_use_cache"] else config["cache_path"],
+                                      common.get_rules_hash(config["scan_engine"], default_rules_path), config["cache_max_entries"],
+                                      config["results_db_path"] if config["use_results_db"] else "", config["scan_engine"], default_rules_path)
+
+    # opens the cache before any analysis (it gets invalidated if the rules have changed)
+    logger.debug("opening scan cache...")
+    scan_cache = scan_context.get_scan_cache()
+    results_store = scan_context.get_results_store()
+
+    # loads the state of the previous analyses
+    state = common.load_state(state_path)
+    if "repositories" not in state:
+        state["repositories"] = {}
+    previous_state = dict(state["repositories"])
+
     # takes the time before analysis (for statistics)
     time_before_analysis = time.time()
-
-    # creates the queue of repo to analyze by the worker threads
+    analysis_start = datetime.datetime.now(datetime.timezone.utc)
+
+    # creates the pipeline running the analyses of the cloned repositories
+    # the profiler is started before any worker thread, so that every one of them is profiled
+    profiler = None
+    profiles_path = config["path"] + "profiles/"
+    if config["profile"]:
+        if not os.path.exists(profiles_path):
+            os.mkdir(profiles_path)
+        profiler = common.Profiler(config["profile"], config["profile_interval"])
+        profiler.start()
+
+    progress = common.ProgressReporter("repositories", None, config["progress_interval"])
+    pipeline = common.ScanPipeline(config["num_processes"], config["max_pending_scans"], use_debug_mode, filename, config["profile"], config["profile_interval"],
+                                   profiles_path, progress)
+    metrics_exporter = None
+    if config["metrics_path"] or config["metrics_port"]:
+        metrics_exporter = common.MetricsExporter(program_name, pipeline, config["metrics_path"], config["metrics_port"], config["metrics_interval"])
+    progress.start()
+
+    # creates the queue of repo to clone by the worker threads
     work_queue = Queue()
 
     # launch as much worker threads as specified by `num_worker_threads`
@@ -261,24 +510,76 @@ def main(argv):
 
     # list all repos within the given workspace and add each one to the analysis queue
     logger.debug("adding analysis tasks...")
-    for repo in workspace.repositories.each():
-        url = repo.get_data("links")["clone"][1]["href"]
-        name = url.rsplit('/', 1)[-1][:-4]
-        if (len(config["whitelist"]) == 0 or name in config["whitelist"]) and name not in config["blacklist"]:
-            work_queue.put((url, name, clones_path, results_path, gitleaks_results_path))
+    num_skipped_repositories = 0
+    num_excluded_repositories = 0
+    num_queued_repositories = 0
+    # the repositories are listed page by page while the first ones are cloned
+    with pipeline.measure("list", ""):
+        for repo in workspace.repositories.each():
+            url = repo.get_data("links")["clone"][1]["href"]
+            name = url.rsplit('/', 1)[-1][:-4]
+
+            # the excluded repositories are never cloned
+            if not common.is_source_included(name, whitelist_re, blacklist_re):
+                num_excluded_repositories += 1
+                continue
+
+            updated_on = repo.get_data("updated_on")
+            repository_state = state["repositories"].get(name)
+
+            # skips the repositories which haven't been updated since their last analysis, before any git traffic
+            if repository_state and repository_state.get(get_state_prefix() + "updated_on") == updated_on and get_last_analyzed_head(name):
+                num_skipped_repositories += 1
+                continue
+
+            work_queue.put((url, name, updated_on, clones_path, results_path, gitleaks_results_path, staging_path))
+            num_queued_repositories += 1
+
+    logger.info("excluded {} repositories through the whitelist and blacklist".format(num_excluded_repositories))
+    logger.info("skipped {} repositories which haven't been updated since their last analysis".format(num_skipped_repositories))
+    progress.set_total_sources(num_queued_repositories)
 
     # wait for all tasks to finish
     work_queue.join()
+    pipeline.join()
+    pipeline.shutdown()
+    progress.stop()
+
+    # the repositories which couldn't be analyzed will be analyzed again by the next analysis
+    for name in pipeline.failed_sources:
+        if name in previous_state:
+            state["repositories"][name] = previous_state[name]
+        else:
+            state["repositories"].pop(name, None)
 
     # saves the time after analysis and shows the time spent analyzing for statistics
     time_after_analysis = time.time()
     logger.info('time spent analyzing: %.2fs', time_after_analysis - time_before_analysis)
+    common.log_filter_statistics(pipeline.statistics, config["file_filters"], config["content_filters"])
+
+    # the time spent in each stage of the analysis
+    common.log_stage_metrics(pipeline.statistics)
+    common.save_run_report(config["run_report_path"], common.create_run_report(program_name, pipeline.statistics, analysis_start,
+                                                                               datetime.datetime.now(datetime.timezone.utc), num_queued_repositories,
+                                                                               pipeline.failed_sources))
+    if metrics_exporter:
+        metrics_exporter.stop()
+    if profiler:
+        common.save_profile(profiler, config["path"] + "profile", profiles_path)
+
+    # saves the state for the next analysis
+    common.save_state(state_path, state)
 
     if save_config_path:
         save_config_file = open(save_config_path, "w")
         save_config_file.write(json.dumps(config, indent=4))
         save_config_file.close()
 
+    if scan_cache:
+        scan_cache.close()
+    if results_store:
+        results_store.close()
+
     # close the atlassian account
     account.close()
 
@@ -2,9 +2,62 @@
 # coding: utf-8
 
 import re
+import sys
+import json
+import heapq
+import shutil
+import time
+import queue
+import sqlite3
+import datetime
+import fnmatch
+import pstats
+import hashlib
 import logging
+import cProfile
 import os.path
+import tempfile
+import contextlib
+import collections
+import threading
 import subprocess
+import multiprocessing
+from threading import Thread
+import email.utils
+import urllib.parse
+import leak_engine
+import concurrent.futures
+from requests import Session
+from requests.adapters import HTTPAdapter
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the logger to use throughout the module
+logger = logging.getLogger(__name__)
+# the gitleaks configuration used for every analysis
+gitleaks_config_path = "filters/gitleaks.toml"
+# the scan caches opened by the current process (indexed by their path)
+scan_caches = {}
+# the results stores opened by the current process (indexed by their path)
+results_stores = {}
+# the prefilters compiled by the current process (indexed by their rules)
+prefilters = {}
+# the lock protecting the opening of scan caches
+scan_caches_lock = threading.Lock()
+results_stores_lock = threading.Lock()
+prefilters_lock = threading.Lock()
+# how far back an incremental analysis looks before the last analysis (the services interpret dates in the timezone of
+# the user, a day covers every timezone)
+incremental_overlap = datetime.timedelta(days=1)
+# the stages of an analysis: listing the sources and documents, fetching the documents (downloads, clones), writing them
+# to disk, scanning them, parsing the findings, filtering them, merging them with the previous results and serializing
+# the results
+stages = ("list", "fetch", "write", "scan", "parse", "filter", "merge", "serialize")
+# upper bounds of the buckets of the latency histograms of the stages, in seconds
+stage_buckets = (0.001, 0.005, 0.025, 0.1, 0.5, 2.5, 10, 60, 300, float("inf"))
+# number of latency samples of an endpoint needed before its latency can reduce the number of concurrent requests
+min_latency_samples = 10
 
 
 # from: https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
@@ -23,76 +76,155 @@ class GitLeak:
         self.fingerprint = fingerprint
 
 
-def deserialize_gitleaks(path, file_filters_re, content_filters_re):
-    leaks = []
-
+def read_gitleaks_report(path):
+    # reads the findings of a json gitleaks report one at a time, this way a report is never fully held in memory
     if not os.path.exists(path):
-        return leaks
+        return
 
+    decoder = json.JSONDecoder()
     file = open(path, "r")
-    lines = file.readlines()
-
-    # parse gitleaks logs
-    if len(lines) > 0:
-        i = 0
+    buffer = ""
 
+    try:
         while True:
-            if i >= len(lines) or not lines[i].startswith("Finding:     "):
+            chunk = file.read(65536)
+            buffer += chunk
+            i = 0
+
+            while True:
+                # skip everything between two findings (whitespaces, commas and the brackets of the array)
+                while i < len(buffer) and buffer[i] in " \t\r\n,[]":
+                    i += 1
+
+                if i >= len(buffer):
+                    break
+
+                try:
+                    finding, i = decoder.raw_decode(buffer, i)
+                except json.JSONDecodeError:
+                    # the finding is not complete yet, it needs more data
+                    if not chunk:
+                        raise
+                    break
+
+                yield finding
+
+            buffer = buffer[i:]
+
+            if not chunk:
                 break
+    finally:
+        file.close()
 
-            finding = lines[i].partition("Finding:     ")[2]
-            i += 1
 
-            while not lines[i].startswith("Secret:      "):
-                finding += lines[i]
-                i += 1
+def combine_filters(filters_re):
+    # the filters are combined into non-capturing groups of a single regex, so a finding is searched once
+    patterns = []
+    for filter_re in filters_re:
+        # the backreferences would point to the groups of another filter once combined, and the flags given to re.compile would
+        # be lost, these filters are searched one by one
+        if re.search(r"\\[1-9]|\(\?P=", filter_re.pattern) or filter_re.flags != re.compile(filter_re.pattern).flags:
+            return None
 
-            finding = finding.rstrip()
-            secret = lines[i].partition("Secret:      ")[2]
-            i += 1
+        # the flags at the start of a filter only apply to this filter once combined
+        flags = re.match(r"\(\?([aiLmsux]+)\)", filter_re.pattern)
+        pattern = "(?{}:{})".format(flags.group(1), filter_re.pattern[flags.end():]) if flags else filter_re.pattern
+        patterns.append("(?:{})".format(pattern))
 
-            while not lines[i].startswith("RuleID:      "):
-                secret += lines[i]
-                i += 1
+    try:
+        # without any filter, nothing matches
+        return re.compile("|".join(patterns) or "(?!)")
+    except re.error:
+        return None
 
-            secret = secret.rstrip()
-            rule_id = lines[i].partition("RuleID:      ")[2].rstrip()
-            entropy = lines[i + 1].partition("Entropy:     ")[2].rstrip()
-            file = lines[i + 2].partition("File:        ")[2].rstrip()
-            line = lines[i + 3].partition("Line:        ")[2].rstrip()
-            fingerprint = lines[i + 4].partition("Fingerprint: ")[2].rstrip()
-            i += 6
 
-            should_exclude = False
+def find_filter(filters_re, text, combined_re=None):
+    # most of the findings match none of the filters, only the ones matching the combined regex are searched filter by filter
+    if combined_re is not None and not combined_re.search(text):
+        return None
 
-            # check the file against the file exclusion filters
-            for file_filter in file_filters_re:
-                if file_filter.search(file):
-                    should_exclude = True
-                    break
+    # the first filter matching the text (if any)
+    for filter_re in filters_re:
+        if filter_re.search(text):
+            return filter_re
+    return None
 
-            # check the finding against the content exclusion filters
-            for content_filter in content_filters_re:
-                if content_filter.search(finding):
-                    should_exclude = True
-                    break
 
-            # if the leak is not set for exclusion (it seems to be relevant) we add it to the list of leaks
-            if not should_exclude:
-                leaks.append(GitLeak(finding, secret, rule_id, entropy, file, line, fingerprint))
+def deserialize_gitleaks(path, file_filters_re, content_filters_re, statistics=None, source=""):
+    leaks = []
+    start = time.perf_counter()
+    filter_time = 0
+    combined_filters_re = None
+
+    # parse gitleaks report
+    for finding in read_gitleaks_report(path):
+        match = finding["Match"].strip()
+        file = finding["File"]
+
+        # check the file against the file exclusion filters, then the finding against the content exclusion filters
+        filter_start = time.perf_counter()
+        # the filters are only combined for the reports which have findings
+        if combined_filters_re is None:
+            combined_filters_re = (combine_filters(file_filters_re), combine_filters(content_filters_re))
+        file_filter = find_filter(file_filters_re, file, combined_filters_re[0])
+        content_filter = find_filter(content_filters_re, match, combined_filters_re[1]) if file_filter is None else None
+        filter_time += time.perf_counter() - filter_start
+
+        # counts the findings excluded by each filter
+        if statistics is not None:
+            if file_filter is not None:
+                statistics[("file_filters", file_filter.pattern)] += 1
+            elif content_filter is not None:
+                statistics[("content_filters", content_filter.pattern)] += 1
+
+        # if the leak is not set for exclusion (it seems to be relevant) we add it to the list of leaks
+        if file_filter is None and content_filter is None:
+            leaks.append(GitLeak(match, finding["Secret"].strip(), finding["RuleID"], str(finding["Entropy"]), file, str(finding["StartLine"]),
+                                 finding["Fingerprint"]))
+
+    # the time spent parsing the report doesn't include the filters
+    observe_stage(statistics, "parse", source, time.perf_counter() - start - filter_time)
+    observe_stage(statistics, "filter", source, filter_time)
 
     return leaks
 
 
+def log_filter_statistics(statistics, file_filters, content_filters):
+    # the filters which never matched may be outdated, the others are sorted by number of excluded findings
+    for name, filters in (("file_filters", file_filters), ("content_filters", content_filters)):
+        for pattern in sorted(filters, key=lambda pattern: statistics[(name, pattern)], reverse=True):
+            if statistics[(name, pattern)]:
+                logger.info("{} excluded {} findings: {}".format(name, statistics[(name, pattern)], pattern))
+            else:
+                logger.info("{} never matched: {}".format(name, pattern))
+
+
+def serialize_gitleaks(path, findings):
+    # if there are findings, save them in a report
+    # else, remove the report (we have fixed all the leaks)
+    if findings:
+        file = open(path, "w")
+        json.dump(findings, file, indent=1)
+        file.close()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
 class LeakCsv:
-    def __init__(self, file, line, secret, comment):
+    def __init__(self, file, line, secret, comment, rule_id="", fingerprint=""):
         self.file = file
         self.line = line
         self.secret = secret
         self.comment = comment
+        # only kept by the results store, the csv files don't have these columns
+        self.rule_id = rule_id
+        self.fingerprint = fingerprint
+
 
+def deserialize_csv(path, results_store=None):
+    if results_store:
+        return results_store.get(path)
 
-def deserialize_csv(path):
     csv = []
 
     if os.path.exists(path):
@@ -106,18 +238,23 @@ def deserialize_csv(path):
             csv_lines.pop(0)
 
         for csv_line in csv_lines:
-            csv_line = csv_line.split(";")
+            # the secrets can contain escaped separators and the columns are padded when serialized
+            csv_line = re.split(r"(?<!\\);", csv_line, 3)
 
             if len(csv_line) >= 4:
-                csv.append(LeakCsv(csv_line[0], csv_line[1], csv_line[2], csv_line[3].rstrip()))
+                csv.append(LeakCsv(csv_line[0].rstrip(), csv_line[1].rstrip(), csv_line[2].rstrip().replace("\\;", ";"), csv_line[3].rstrip()))
 
     return csv
 
 
-def serialize_csv(path, csv, message=""):
+def serialize_csv(path, csv, message="", results_store=None, source=""):
     if not path:
         return
 
+    if results_store:
+        results_store.put(path, csv, message, source)
+        return
+
     # if the csv is empty, remove it if it exists (we have fixed all the leaks) and return
     if not csv:
         if os.path.exists(path):
@@ -146,7 +283,60 @@ def serialize_csv(path, csv, message=""):
     file.close()
 
 
-def gitleaks_to_csv(leaks, repo_name):
+def process_gitleaks_report(log_file_path, processed_log_file_path, name, file_filters_re, content_filters_re, message="", results_store=None, source="",
+                            statistics=None, is_history=False):
+    # removes the report if it doesn't contain any finding (we have fixed all the leaks)
+    if os.path.exists(log_file_path) and next(read_gitleaks_report(log_file_path), None) is None:
+        os.remove(log_file_path)
+
+    # deserialize the gitleaks report
+    leaks = deserialize_gitleaks(log_file_path, file_filters_re, content_filters_re, statistics, source)
+
+    with measure_stage(statistics, "merge", source):
+        # convert from gitleaks format to csv format
+        csv = gitleaks_to_csv(leaks, name, is_history)
+
+        # load the last generated csv file if it exists to export the comments to te new one
+        resolved = carry_over_comments(csv, deserialize_csv(processed_log_file_path, results_store))
+    if resolved:
+        logger.info("{} leak(s) resolved since the last analysis of {}".format(len(resolved), name))
+        for old_line in resolved:
+            logger.debug("resolved leak: {} (line {})".format(old_line.file, old_line.line))
+
+        # the secret column holds gitleaks' match instead of its verbose finding, the results of an older version don't
+        # match the new ones once: the triaged leaks still found at the same lines are most likely the same leaks
+        positions = set((line.file, line.line) for line in csv)
+        lost_comments = [old_line for old_line in resolved if old_line.comment and (old_line.file, old_line.line) in positions]
+        if lost_comments:
+            logger.warning("{} comment(s) of {} weren't carried over although a leak is still found at the same line, if the previous results were written "
+                           "by an older version their secret column has changed format (see the README to migrate them)".format(len(lost_comments), name))
+
+    # serialize the csv into a file
+    with measure_stage(statistics, "serialize", source):
+        serialize_csv(processed_log_file_path, csv, message, results_store, source)
+
+    return resolved
+
+
+def carry_over_comments(csv, old_csv):
+    # indexes the comments of the previous results once, instead of looking them up for every new line
+    comments = {}
+    for old_line in old_csv:
+        if old_line.comment:
+            comments.setdefault((old_line.file, old_line.secret), old_line.comment)
+
+    secrets = set()
+    for line in csv:
+        secrets.add((line.file, line.secret))
+
+        # if it seems to be the same secret in the same file, we assume they should have the same comment
+        line.comment = comments.get((line.file, line.secret), line.comment)
+
+    # the previous results matching none of the new ones have been fixed
+    return [old_line for old_line in old_csv if (old_line.file, old_line.secret) not in secrets]
+
+
+def gitleaks_to_csv(leaks, repo_name, is_history=False):
     csv = []
 
     for leak in leaks:
@@ -155,7 +345,13 @@ def gitleaks_to_csv(leaks, repo_name):
         if len(formatted_secret) > 48:
             formatted_secret = "{}...".format(formatted_secret[:48])
 
-        csv.append(LeakCsv(repo_name + leak.file.split(repo_name)[1], leak.line, formatted_secret, ""))
+        # the files found in the git history are relative to the repository, the other ones are in the downloads or clones path (which may be relative too)
+        if is_history:
+            file = "{}/{}".format(repo_name, leak.file)
+        else:
+            file = repo_name + leak.file.split(repo_name, 1)[1]
+
+        csv.append(LeakCsv(file, leak.line, formatted_secret, "", leak.rule_id, leak.fingerprint))
 
     return csv
 
@@ -182,6 +378,1451 @@ def initialize_logger(use_debug_mode, filename):
         logging.getLogger().addHandler(log_file_handler)
 
 
-def run_gitleaks(path):
-    return subprocess.run(["gitleaks", "detect", "--no-git", "--verbose", "--config", "filters/gitleaks.toml", "--source", path], stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE).stdout.decode("utf-8")
+def run_gitleaks(path, report_path, log_opts=None):
+    # without log options, only the files are analyzed, otherwise the commits selected by the options are
+    git_options = ["--no-git"] if log_opts is None else ["--log-opts", log_opts]
+
+    # a report left by a previous run would be mistaken for the one of this run
+    if os.path.exists(report_path):
+        os.remove(report_path)
+
+    # the findings are written as a json report, gitleaks' own logs are only kept to explain a failure
+    process = subprocess.run(["gitleaks", "detect"] + git_options + ["--config", gitleaks_config_path, "--report-format", "json", "--report-path", report_path,
+                                                                     "--source", path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # gitleaks exits with 1 when it has found leaks and always writes its report, anything else is a failure which must
+    # not be taken for an analysis without any finding (the previous results are kept and the source is analyzed again)
+    if process.returncode not in (0, 1) or not os.path.exists(report_path):
+        error = escape_ansi_codes(process.stderr.decode("utf-8", "replace")).strip().split("\n")[-1]
+        raise RuntimeError("gitleaks failed on {} (exit code {}): {}".format(path, process.returncode, error))
+
+
+def run_gitleaks_batch(paths, staging_root, scan_cache=None, scan_engine=None):
+    batch_findings = {}
+    cache_keys = {}
+
+    if not paths:
+        return batch_findings
+
+    # reuses the findings of the documents which have already been analyzed with the same content and rules
+    if scan_cache:
+        for path in paths:
+            cache_keys[path] = hash_file(path)
+            findings = scan_cache.get(cache_keys[path], path)
+            if findings is not None:
+                batch_findings[path] = findings
+
+        paths = [path for path in paths if path not in batch_findings]
+
+        if not paths:
+            return batch_findings
+
+    # the engine analyzes the documents within the process, without any staging
+    if scan_engine:
+        for path in paths:
+            batch_findings[path] = scan_engine.scan_file(path)
+            if scan_cache:
+                scan_cache.put(cache_keys[path], batch_findings[path], path)
+        return batch_findings
+
+    # links every document into a single staging directory, this way gitleaks is spawned (and compiles its rules) only
+    # once for the whole batch instead of once per document
+    staging_path = tempfile.mkdtemp(prefix="staging-", dir=staging_root)
+    report_path = staging_path + ".json"
+    originals = {}
+
+    try:
+        for path in paths:
+            name = os.path.basename(path)
+            staged_path = os.path.join(staging_path, name)
+            try:
+                os.link(path, staged_path)
+            except OSError:
+                shutil.copyfile(path, staged_path)
+            originals[name] = path
+
+        run_gitleaks(staging_path, report_path)
+
+        # splits the findings back to the document they were found in, as if gitleaks was run on each document
+        for path in paths:
+            batch_findings[path] = []
+
+        for finding in read_gitleaks_report(report_path):
+            file = finding["File"]
+            path = originals.get(os.path.basename(file))
+            if path is None:
+                continue
+
+            relocate_finding(finding, file, path)
+            batch_findings[path].append(finding)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+    # only reached once gitleaks has succeeded: the findings of a failed analysis are never cached (they would be reused
+    # until the rules change)
+    if scan_cache:
+        for path in paths:
+            scan_cache.put(cache_keys[path], batch_findings[path], path)
+
+    return batch_findings
+
+
+def relocate_finding(finding, staged_path, path):
+    # the staged path is replaced by the original one in the file and the fingerprint of the finding, gitleaks may print
+    # the staged path cleaned (e.g. without a leading ./), so both are normalized before being compared
+    file = finding["File"]
+    relative_path = os.path.relpath(os.path.abspath(file), os.path.abspath(staged_path))
+    finding["File"] = path if relative_path == "." else os.path.join(path, relative_path)
+    if finding["Fingerprint"].startswith(file + ":"):
+        finding["Fingerprint"] = finding["File"] + finding["Fingerprint"][len(file):]
+
+
+def get_repository_shards(clone_path, shard_size):
+    entries = {}
+    total_size = 0
+
+    # sizes the files of the repository by top-level directory (gitleaks doesn't follow symlinks)
+    for root, directories, files in os.walk(clone_path):
+        directories[:] = [directory for directory in directories if directory != ".git"]
+        for file in files:
+            path = os.path.join(root, file)
+            if os.path.islink(path):
+                continue
+
+            relative_path = os.path.relpath(path, clone_path)
+            size = os.path.getsize(path)
+            entry = entries.setdefault(relative_path.split(os.sep, 1)[0], [])
+            entry.append((size, relative_path))
+            total_size += size
+
+    num_shards = -(-total_size // shard_size)
+    if num_shards <= 1:
+        return []
+
+    # the top-level directories are kept together unless they are larger than a shard, then their files are spread
+    groups = []
+    for entry in entries.values():
+        entry_size = sum(size for size, _ in entry)
+        if entry_size > shard_size:
+            groups.extend((size, [relative_path]) for size, relative_path in entry)
+        else:
+            groups.append((entry_size, [relative_path for _, relative_path in entry]))
+
+    # the largest groups are given first to the smallest shard so that the shards end up with similar sizes
+    shards = [(0, i, []) for i in range(num_shards)]
+    for size, files in sorted(groups, key=lambda group: group[0], reverse=True):
+        current_size, i, shard_files = heapq.heappop(shards)
+        shard_files.extend(files)
+        heapq.heappush(shards, (current_size + size, i, shard_files))
+
+    return [shard_files for _, _, shard_files in shards if shard_files]
+
+
+def get_history_shards(clone_path, last_commit, shard_commits):
+    commits = subprocess.run(["git", "-C", clone_path, "rev-list", "--topo-order", "--reverse", "{}..HEAD".format(last_commit) if last_commit else "HEAD"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.split()
+
+    if len(commits) <= shard_commits:
+        return []
+
+    # each shard analyzes the commits reachable from its last commit which aren't reachable from the previous shard's one,
+    # together they cover the whole range (a commit of a merged branch can be analyzed twice, its findings are deduplicated)
+    shards = []
+    start = last_commit
+    for i in range(shard_commits - 1, len(commits) + shard_commits - 1, shard_commits):
+        end = commits[min(i, len(commits) - 1)]
+        shards.append("{}..{}".format(start, end) if start else end)
+        start = end
+
+    return shards
+
+
+def analyze_repository_shard(context, clone_path, files, staging_root, report_path):
+    statistics = collections.Counter()
+    with measure_stage(statistics, "scan", os.path.basename(clone_path.rstrip("/"))):
+        scan_repository_shard(context, clone_path, files, staging_root, report_path)
+    return statistics
+
+
+def scan_repository_shard(context, clone_path, files, staging_root, report_path):
+    scan_engine = context.get_scan_engine()
+
+    if scan_engine:
+        serialize_gitleaks(report_path, [finding for file in files for finding in scan_engine.scan_file(os.path.join(clone_path, file))])
+        return
+
+    # links the files of the shard into a staging directory with the same layout as the repository (gitleaks is given an
+    # absolute path, whatever the output path)
+    staging_path = tempfile.mkdtemp(prefix="shard-", dir=os.path.abspath(staging_root))
+
+    try:
+        for file in files:
+            staged_path = os.path.join(staging_path, file)
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            try:
+                os.link(os.path.join(clone_path, file), staged_path)
+            except OSError:
+                shutil.copyfile(os.path.join(clone_path, file), staged_path)
+
+        run_gitleaks(staging_path, report_path)
+
+        findings = []
+        for finding in read_gitleaks_report(report_path):
+            relocate_finding(finding, staging_path, clone_path.rstrip("/"))
+            findings.append(finding)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    serialize_gitleaks(report_path, findings)
+
+
+def analyze_history_shard(clone_path, log_opts, report_path):
+    statistics = collections.Counter()
+    with measure_stage(statistics, "scan", os.path.basename(clone_path.rstrip("/"))):
+        run_gitleaks(clone_path, report_path, log_opts)
+    return statistics
+
+
+def merge_gitleaks_reports(report_paths, log_file_path):
+    findings = []
+    fingerprints = set()
+
+    # a finding can be reported by several shards (e.g. a commit reachable from two commit ranges)
+    for report_path in report_paths:
+        # a missing report would be merged (and cached) as a shard without any finding
+        if not os.path.exists(report_path):
+            raise RuntimeError("the report of a shard is missing: {}".format(report_path))
+
+        for finding in read_gitleaks_report(report_path):
+            if finding["Fingerprint"] not in fingerprints:
+                fingerprints.add(finding["Fingerprint"])
+                findings.append(finding)
+
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+    serialize_gitleaks(log_file_path, findings)
+
+    return findings
+
+
+def hash_file(path):
+    file_hash = hashlib.sha256()
+
+    file = open(path, "rb")
+    for chunk in iter(lambda: file.read(65536), b""):
+        file_hash.update(chunk)
+    file.close()
+
+    return file_hash.hexdigest()
+
+
+def get_rules_hash(scan_engine="gitleaks", default_rules_path=""):
+    rules_hash = hashlib.sha256()
+
+    # the default rules (pulled through `useDefault`) depend on the version of gitleaks
+    rules_hash.update(subprocess.run(["gitleaks", "version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout)
+
+    file = open(gitleaks_config_path, "rb")
+    rules_hash.update(file.read())
+    file.close()
+
+    # the findings of the python engine can slightly differ from the ones of gitleaks, and its default rules are given
+    if scan_engine != "gitleaks":
+        rules_hash.update(scan_engine.encode("utf-8"))
+        if default_rules_path:
+            file = open(default_rules_path, "rb")
+            rules_hash.update(file.read())
+            file.close()
+
+    return rules_hash.hexdigest()
+
+
+def load_engine_rules(default_rules_path, download_path, scan_engine="python"):
+    # the python engine and the prefilter need python 3.11 or above and the default rules of gitleaks (downloaded once for
+    # the installed version if they aren't given), they are loaded once before the analysis instead of failing every batch
+    if not default_rules_path:
+        default_rules_path = leak_engine.get_default_rules_path(download_path)
+
+    engine = leak_engine.get_engine(gitleaks_config_path, default_rules_path)
+
+    # gitleaks still applies the rules python couldn't compile, the prefilter would skip the documents only they can match
+    if scan_engine != "python" and engine.skipped_rules:
+        raise RuntimeError("couldn't compile the rules: {}".format(", ".join(engine.skipped_rules)))
+
+    return default_rules_path
+
+
+class KeywordPrefilter:
+    # a rule can only match a document containing one of its keywords, or its regex if it doesn't have any keyword,
+    # the documents which can't be matched by any rule don't need to be analyzed
+    def __init__(self, rules):
+        keywords = set()
+        self.regexes = []
+        self.paths = []
+
+        for rule in rules:
+            if rule.keywords:
+                keywords.update(rule.keywords)
+            elif rule.regex:
+                self.regexes.append(rule.regex)
+            elif rule.path:
+                self.paths.append(rule.path)
+
+        # all the keywords are looked for at once
+        self.keywords_re = re.compile("|".join(re.escape(keyword) for keyword in sorted(keywords))) if keywords else None
+
+    def may_match(self, content, path):
+        if any(regex.search(path) for regex in self.paths):
+            return True
+
+        # the keywords are lower case, as gitleaks looks for them in the lower case content
+        if self.keywords_re and self.keywords_re.search(content.lower()):
+            return True
+
+        return any(regex.search(content) for regex in self.regexes)
+
+
+def log_prefilter_statistics(statistics, name):
+    if statistics["prefiltered_documents"]:
+        logger.info("prefilter skipped {} of {} {} ({:.1f}%)".format(statistics["skipped_documents"], statistics["prefiltered_documents"], name,
+                                                                    100.0 * statistics["skipped_documents"] / statistics["prefiltered_documents"]))
+
+
+class ScanCache:
+    def __init__(self, path, rules_hash, max_entries):
+        self.max_entries = max_entries
+        self.num_puts = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scans (key TEXT PRIMARY KEY, findings TEXT NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS scans_last_used ON scans (last_used)")
+
+            # the cached findings are worthless if the rules have changed since they were computed
+            row = self.connection.execute("SELECT value FROM metadata WHERE name = 'rules_hash'").fetchone()
+            if row is None or row[0] != rules_hash:
+                if row is not None:
+                    logger.info("gitleaks rules have changed, invalidating the scan cache")
+                self.connection.execute("DELETE FROM scans")
+                self.connection.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES ('rules_hash', ?)", (rules_hash,))
+
+    def get(self, key, root):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT findings FROM scans WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE scans SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        # the findings are stored relatively to the analyzed source, they are moved back to the given one
+        findings = json.loads(row[0])
+        for finding in findings:
+            file = root if finding["File"] == "." else os.path.join(root, finding["File"])
+            if finding["Fingerprint"].startswith(finding["File"] + ":"):
+                finding["Fingerprint"] = file + finding["Fingerprint"][len(finding["File"]):]
+            finding["File"] = file
+
+        return findings
+
+    def put(self, key, findings, root):
+        # the findings are stored relatively to the analyzed source, as the same content can be found at another path
+        relative_findings = []
+        for finding in findings:
+            finding = dict(finding)
+            file = os.path.relpath(finding["File"], root)
+            if finding["Fingerprint"].startswith(finding["File"] + ":"):
+                finding["Fingerprint"] = file + finding["Fingerprint"][len(finding["File"]):]
+            finding["File"] = file
+            relative_findings.append(finding)
+
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO scans (key, findings, last_used) VALUES (?, ?, ?)", (key, json.dumps(relative_findings), time.time()))
+            self.num_puts += 1
+
+            # evicts the least recently used entries once in a while if the cache is too big
+            if self.num_puts % 1000 == 0:
+                self.evict()
+
+    def evict(self):
+        num_entries = self.connection.execute("SELECT COUNT(*) FROM scans").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute("DELETE FROM scans WHERE key IN (SELECT key FROM scans ORDER BY last_used LIMIT ?)", (num_entries - self.max_entries,))
+
+    def close(self):
+        with self.lock, self.connection:
+            self.evict()
+        self.connection.close()
+
+
+class ResultsStore:
+    # keeps the results of every document in a single database instead of a csv file per document, a document is named
+    # after the csv file it replaces (e.g. "results/123.csv" is the document "123")
+    def __init__(self, path):
+        self.batch_depth = 0
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS documents (document TEXT PRIMARY KEY, source TEXT NOT NULL, message TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (document TEXT NOT NULL, position INTEGER NOT NULL, file TEXT NOT NULL, line TEXT NOT NULL, "
+                                    "secret TEXT NOT NULL, comment TEXT NOT NULL, rule_id TEXT NOT NULL, fingerprint TEXT NOT NULL, PRIMARY KEY (document, position))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS documents_source ON documents (source)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_rule_id ON results (rule_id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_fingerprint ON results (fingerprint)")
+
+    @staticmethod
+    def get_document(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    @contextlib.contextmanager
+    def batch(self):
+        # the results written within a batch are committed at once
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.connection.commit()
+
+    def get(self, path):
+        with self.lock:
+            rows = self.connection.execute("SELECT file, line, secret, comment, rule_id, fingerprint FROM results WHERE document = ? ORDER BY position",
+                                           (self.get_document(path),)).fetchall()
+
+        return [LeakCsv(*row) for row in rows]
+
+    def put(self, path, csv, message="", source=""):
+        document = self.get_document(path)
+
+        with self.batch():
+            self.connection.execute("DELETE FROM results WHERE document = ?", (document,))
+
+            # if the csv is empty, the document is removed (we have fixed all the leaks)
+            if not csv:
+                self.connection.execute("DELETE FROM documents WHERE document = ?", (document,))
+                return
+
+            self.connection.execute("INSERT OR REPLACE INTO documents (document, source, message) VALUES (?, ?, ?)", (document, source, message))
+            self.connection.executemany("INSERT INTO results (document, position, file, line, secret, comment, rule_id, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [(document, i, line.file, line.line, line.secret, line.comment, line.rule_id, line.fingerprint) for i, line in enumerate(csv)])
+
+    def remove(self, path):
+        self.put(path, [])
+
+    def get_documents(self, source=None):
+        with self.lock:
+            if source is None:
+                return self.connection.execute("SELECT document, source, message FROM documents ORDER BY document").fetchall()
+            return self.connection.execute("SELECT document, source, message FROM documents WHERE source = ? ORDER BY document", (source,)).fetchall()
+
+    def query(self, source=None, rule_id=None, fingerprint=None):
+        conditions = []
+        parameters = []
+        for column, value in (("documents.source", source), ("results.rule_id", rule_id), ("results.fingerprint", fingerprint)):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                parameters.append(value)
+
+        with self.lock:
+            return self.connection.execute("SELECT documents.source, results.document, results.file, results.line, results.secret, results.comment, results.rule_id, "
+                                           "results.fingerprint FROM results JOIN documents ON documents.document = results.document" +
+                                           (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY results.document, results.position",
+                                           parameters).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+        self.connection.close()
+
+
+def compile_source_patterns(patterns):
+    # the patterns are globs (an exact name is a glob too) unless they are prefixed by "re:"
+    return [re.compile(pattern[3:]) if pattern.startswith("re:") else re.compile(r"\A" + fnmatch.translate(pattern)) for pattern in patterns]
+
+
+def is_source_included(key, whitelist_re, blacklist_re):
+    return (not whitelist_re or any(pattern.search(key) for pattern in whitelist_re)) and not any(pattern.search(key) for pattern in blacklist_re)
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+
+    file = open(path, "r")
+    state = json.load(file)
+    file.close()
+
+    return state
+
+
+def save_state(path, state):
+    # writes a temporary file first, this way an interrupted program never leaves a corrupted state behind
+    file = open(path + ".tmp", "w")
+    json.dump(state, file, indent=4)
+    file.close()
+    os.replace(path + ".tmp", path)
+
+
+def remove_document_results(name, downloads_path, results_path, gitleaks_results_path, results_store=None):
+    if results_store:
+        results_store.remove("{}{}.csv".format(results_path, name))
+
+    for path in ("{}{}.html".format(downloads_path, name), "{}{}.log".format(gitleaks_results_path, name), "{}{}.csv".format(results_path, name)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def paginate(fetch_page, page_size, prefetch=1):
+    # yields the documents of a paginated api one at a time, the next pages are fetched by a background thread (at most
+    # `prefetch` pages ahead) so that downloading continues while the documents are processed
+    pages = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+
+    def put_page(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch_pages():
+        try:
+            start = 0
+            while not stopped.is_set():
+                documents = fetch_page(start, page_size)
+                # an empty page marks the end, a smaller page may just be the limit of the server
+                if not documents:
+                    break
+                put_page(documents)
+                start += len(documents)
+            put_page(None)
+        except Exception as e:
+            put_page(e)
+
+    Thread(target=fetch_pages, daemon=True).start()
+
+    try:
+        while True:
+            documents = pages.get()
+            if documents is None:
+                break
+            if isinstance(documents, Exception):
+                raise documents
+            yield from documents
+    finally:
+        stopped.set()
+
+
+class Document:
+    def __init__(self, name, path, log_file_path, processed_log_file_path, message, source=""):
+        self.name = name
+        self.path = path
+        self.log_file_path = log_file_path
+        self.processed_log_file_path = processed_log_file_path
+        self.message = message
+        self.source = source
+
+
+class ScanContext:
+    def __init__(self, file_filters_re, content_filters_re, cache_path, rules_hash, cache_max_entries, results_db_path="", scan_engine="gitleaks", default_rules_path="",
+                 use_prefilter=False):
+        self.file_filters_re = file_filters_re
+        self.content_filters_re = content_filters_re
+        self.cache_path = cache_path
+        self.results_db_path = results_db_path
+        self.scan_engine = scan_engine
+        self.default_rules_path = default_rules_path
+        self.use_prefilter = use_prefilter
+        self.rules_hash = rules_hash
+        self.cache_max_entries = cache_max_entries
+
+        # identifies the rules and filters of the analysis, the results of a previous analysis with another one are outdated
+        analysis_hash = hashlib.sha256(rules_hash.encode("utf-8"))
+        analysis_hash.update(json.dumps([[pattern.pattern for pattern in file_filters_re], [pattern.pattern for pattern in content_filters_re]]).encode("utf-8"))
+        self.analysis_hash = analysis_hash.hexdigest()
+
+    def get_scan_cache(self):
+        if not self.cache_path:
+            return None
+
+        # each process opens its own connection to the cache
+        with scan_caches_lock:
+            if self.cache_path not in scan_caches:
+                scan_caches[self.cache_path] = ScanCache(self.cache_path, self.rules_hash, self.cache_max_entries)
+            return scan_caches[self.cache_path]
+
+    def get_results_store(self):
+        if not self.results_db_path:
+            return None
+
+        # same for the results store
+        with results_stores_lock:
+            if self.results_db_path not in results_stores:
+                results_stores[self.results_db_path] = ResultsStore(self.results_db_path)
+            return results_stores[self.results_db_path]
+
+    def get_scan_engine(self):
+        # gitleaks is run as a subprocess, the python engine compiles its rules once per process
+        if self.scan_engine != "python":
+            return None
+
+        return leak_engine.get_engine(gitleaks_config_path, self.default_rules_path)
+
+    def get_prefilter(self):
+        if not self.use_prefilter:
+            return None
+
+        # the prefilter is built from the same rules as the python engine
+        with prefilters_lock:
+            if self.default_rules_path not in prefilters:
+                prefilters[self.default_rules_path] = KeywordPrefilter(leak_engine.get_engine(gitleaks_config_path, self.default_rules_path).rules)
+            return prefilters[self.default_rules_path]
+
+
+def analyze_documents(context, documents, staging_root):
+    statistics = collections.Counter()
+    # the documents of a batch belong to the same source
+    source = documents[0].source if documents else ""
+
+    with measure_stage(statistics, "scan", source):
+        # only the documents which may contain a leak are analyzed, the others don't have any finding
+        candidates = documents
+        prefilter = context.get_prefilter()
+        if prefilter:
+            candidates = []
+            for document in documents:
+                file = open(document.path, "r", errors="replace")
+                if prefilter.may_match(file.read(), document.path):
+                    candidates.append(document)
+                file.close()
+
+            statistics["prefiltered_documents"] += len(documents)
+            statistics["skipped_documents"] += len(documents) - len(candidates)
+
+        # checks for leak in all the documents at once using gitleaks and store the findings of each document
+        batch_findings = run_gitleaks_batch([document.path for document in candidates], staging_root, context.get_scan_cache(), context.get_scan_engine())
+
+    # the results of the whole batch are written at once
+    results_store = context.get_results_store()
+    with results_store.batch() if results_store else contextlib.nullcontext():
+        for document in documents:
+            serialize_gitleaks(document.log_file_path, batch_findings.get(document.path, []))
+            process_gitleaks_report(document.log_file_path, document.processed_log_file_path, document.name, context.file_filters_re, context.content_filters_re,
+                                    document.message, results_store, document.source, statistics)
+
+    return statistics
+
+
+def analyze_repository(context, name, clone_path, log_file_path, processed_log_file_path, cache_key):
+    statistics = collections.Counter()
+
+    with measure_stage(statistics, "scan", name):
+        scan_repository(context, clone_path, log_file_path, cache_key)
+
+    # converts the report to a csv file containing the results
+    process_gitleaks_report(log_file_path, processed_log_file_path, name, context.file_filters_re, context.content_filters_re, "", context.get_results_store(), name,
+                            statistics)
+
+    return statistics
+
+
+def scan_repository(context, clone_path, log_file_path, cache_key):
+    scan_cache = context.get_scan_cache()
+
+    # reuses the findings of the last analysis of the same commit with the same rules
+    findings = scan_cache.get(cache_key, clone_path) if scan_cache and cache_key else None
+
+    if findings is not None:
+        serialize_gitleaks(log_file_path, findings)
+    elif context.get_scan_engine():
+        findings = context.get_scan_engine().scan_directory(clone_path)
+        serialize_gitleaks(log_file_path, findings)
+
+        if scan_cache and cache_key:
+            scan_cache.put(cache_key, findings, clone_path)
+    else:
+        # checks for leak using gitleaks and store the findings in a report
+        run_gitleaks(clone_path, log_file_path)
+
+        # only reached once gitleaks has succeeded
+        if scan_cache and cache_key:
+            scan_cache.put(cache_key, list(read_gitleaks_report(log_file_path)), clone_path)
+
+
+def analyze_repository_history(context, name, clone_path, log_file_path, processed_log_file_path, last_commit):
+    statistics = collections.Counter()
+
+    # only analyzes the commits added since the last analyzed one (or the whole history for the first analysis)
+    with measure_stage(statistics, "scan", name):
+        run_gitleaks(clone_path, log_file_path, "{}..HEAD".format(last_commit) if last_commit else "HEAD")
+
+    return process_history_report(context, name, log_file_path, processed_log_file_path, last_commit, statistics)
+
+
+def merge_repository_shards(context, name, clone_path, log_file_path, processed_log_file_path, cache_key, report_paths):
+    statistics = collections.Counter()
+
+    with measure_stage(statistics, "merge", name):
+        findings = merge_gitleaks_reports(report_paths, log_file_path)
+
+        scan_cache = context.get_scan_cache()
+        if scan_cache and cache_key:
+            scan_cache.put(cache_key, findings, clone_path)
+
+    process_gitleaks_report(log_file_path, processed_log_file_path, name, context.file_filters_re, context.content_filters_re, "", context.get_results_store(), name,
+                            statistics)
+
+    return statistics
+
+
+def merge_repository_history_shards(context, name, log_file_path, processed_log_file_path, last_commit, report_paths):
+    statistics = collections.Counter()
+    with measure_stage(statistics, "merge", name):
+        merge_gitleaks_reports(report_paths, log_file_path)
+    return process_history_report(context, name, log_file_path, processed_log_file_path, last_commit, statistics)
+
+
+def process_history_report(context, name, log_file_path, processed_log_file_path, last_commit, statistics=None):
+    if statistics is None:
+        statistics = collections.Counter()
+
+    if not last_commit:
+        process_gitleaks_report(log_file_path, processed_log_file_path, name, context.file_filters_re, context.content_filters_re, "", context.get_results_store(), name,
+                                statistics, True)
+        return statistics
+
+    leaks = deserialize_gitleaks(log_file_path, context.file_filters_re, context.content_filters_re, statistics, name)
+
+    # the secrets found in the previous commits are still in the history, the new ones are added to them
+    results_store = context.get_results_store()
+    with measure_stage(statistics, "merge", name):
+        csv = deserialize_csv(processed_log_file_path, results_store)
+        known_leaks = set((line.file, line.secret) for line in csv)
+
+        for line in gitleaks_to_csv(leaks, name, True):
+            if (line.file, line.secret) not in known_leaks:
+                known_leaks.add((line.file, line.secret))
+                csv.append(line)
+
+    with measure_stage(statistics, "serialize", name):
+        serialize_csv(processed_log_file_path, csv, "", results_store, name)
+
+    return statistics
+
+
+def get_worker_name():
+    # the documents are downloaded by threads and analyzed by processes
+    process_name = multiprocessing.current_process().name
+    return threading.current_thread().name if process_name == "MainProcess" else process_name
+
+
+def observe_stage(statistics, stage, source, duration, worker=None):
+    # the latency histograms are kept in the statistics of the analyses, this way they are merged like any other statistic
+    if statistics is None:
+        return
+
+    worker = worker or get_worker_name()
+    statistics[("stage", stage, source, worker, next(bound for bound in stage_buckets if duration <= bound))] += 1
+    statistics[("stage_seconds", stage, source, worker)] += duration
+
+
+@contextlib.contextmanager
+def measure_stage(statistics, stage, source):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(statistics, stage, source, time.perf_counter() - start)
+
+
+def get_stage_metrics(statistics):
+    # aggregates the observations of the stages by stage (with their histogram), by source and by worker
+    metrics = {"stages": {}, "sources": {}, "workers": {}}
+
+    for key, value in statistics.items():
+        if not isinstance(key, tuple) or key[0] not in ("stage", "stage_seconds"):
+            continue
+
+        stage, source, worker = key[1:4]
+        # the stages which don't belong to a source (e.g. listing the sources)
+        source = source or "*"
+        summaries = [metrics["stages"].setdefault(stage, {"count": 0, "seconds": 0.0, "buckets": collections.Counter()}),
+                     metrics["sources"].setdefault(source, {}).setdefault(stage, {"count": 0, "seconds": 0.0}),
+                     metrics["workers"].setdefault(worker, {}).setdefault(stage, {"count": 0, "seconds": 0.0})]
+
+        for summary in summaries:
+            if key[0] == "stage":
+                summary["count"] += value
+            else:
+                summary["seconds"] += value
+
+        if key[0] == "stage":
+            summaries[0]["buckets"][key[4]] += value
+
+    return metrics
+
+
+def log_stage_metrics(statistics):
+    stage_metrics = get_stage_metrics(statistics)["stages"]
+    for stage in stages:
+        if stage in stage_metrics and stage_metrics[stage]["count"]:
+            summary = stage_metrics[stage]
+            p95 = get_quantile(summary["buckets"], summary["count"], 0.95)
+            logger.info("{} stage: {} runs, {:.2f}s in total, {:.3f}s on average, 95% under {}".format(stage, summary["count"], summary["seconds"],
+                                                                                                     summary["seconds"] / summary["count"],
+                                                                                                     "{}s".format(p95) if p95 else "the last bucket"))
+
+
+def get_quantile(buckets, count, quantile):
+    # estimates a quantile from a histogram, as the upper bound of the bucket in which it falls (none if beyond the last
+    # bound)
+    total = 0
+    for bound in stage_buckets[:-1]:
+        total += buckets[bound]
+        if total >= quantile * count:
+            return bound
+    return None
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else str(bound)
+
+
+def create_run_report(program_name, statistics, start, end, num_sources, failed_sources):
+    metrics = get_stage_metrics(statistics)
+
+    stage_reports = {}
+    for stage in sorted(metrics["stages"], key=lambda stage: stages.index(stage) if stage in stages else len(stages)):
+        summary = metrics["stages"][stage]
+        # the bounds of the histogram are cumulative, as in prometheus
+        cumulative = 0
+        buckets = {}
+        for bound in stage_buckets:
+            cumulative += summary["buckets"][bound]
+            buckets[format_bound(bound)] = cumulative
+
+        stage_reports[stage] = {"count": summary["count"], "seconds": round(summary["seconds"], 6),
+                                "mean_seconds": round(summary["seconds"] / summary["count"], 6) if summary["count"] else 0,
+                                "p50_seconds": get_quantile(summary["buckets"], summary["count"], 0.5),
+                                "p95_seconds": get_quantile(summary["buckets"], summary["count"], 0.95), "buckets": buckets}
+
+    def round_summaries(summaries):
+        return {name: {stage: {"count": summary["count"], "seconds": round(summary["seconds"], 6)} for stage, summary in stage_summaries.items()}
+                for name, stage_summaries in sorted(summaries.items())}
+
+    return {"program": program_name, "start": start.isoformat(), "end": end.isoformat(), "seconds": round((end - start).total_seconds(), 3),
+            "sources": num_sources, "failed_sources": sorted(failed_sources), "stages": stage_reports, "by_source": round_summaries(metrics["sources"]),
+            "by_worker": round_summaries(metrics["workers"])}
+
+
+def save_run_report(path, report):
+    file = open(path, "w")
+    file.write(json.dumps(report, indent=4))
+    file.close()
+    logger.info("saved run report to: {}".format(path))
+
+
+def format_prometheus_metrics(program_name, statistics):
+    # the histograms are exported by stage and the time spent by stage and worker, the sources are only in the run report
+    # as there can be too many of them for a monitoring system
+    metrics = get_stage_metrics(statistics)
+    prefix = program_name.replace("-", "_")
+    lines = ["# HELP {}_stage_duration_seconds Duration of the stages of the analysis.".format(prefix),
+             "# TYPE {}_stage_duration_seconds histogram".format(prefix)]
+
+    for stage, summary in sorted(metrics["stages"].items()):
+        cumulative = 0
+        for bound in stage_buckets:
+            cumulative += summary["buckets"][bound]
+            lines.append('{}_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, format_bound(bound), cumulative))
+        lines.append('{}_stage_duration_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, summary["seconds"]))
+        lines.append('{}_stage_duration_seconds_count{{stage="{}"}} {}'.format(prefix, stage, summary["count"]))
+
+    lines.append("# HELP {}_worker_stage_seconds_total Time spent in each stage by each worker.".format(prefix))
+    lines.append("# TYPE {}_worker_stage_seconds_total counter".format(prefix))
+    for worker, stage_summaries in sorted(metrics["workers"].items()):
+        for stage, summary in sorted(stage_summaries.items()):
+            lines.append('{}_worker_stage_seconds_total{{stage="{}",worker="{}"}} {}'.format(prefix, stage, worker, summary["seconds"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    # exposes the metrics of a running analysis in the prometheus text format, through a file rewritten periodically (e.g.
+    # for the textfile collector of node_exporter) and/or an http endpoint
+    def __init__(self, program_name, pipeline, path="", port=0, interval=15):
+        self.program_name = program_name
+        self.pipeline = pipeline
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.server = None
+
+        if port:
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = exporter.get_metrics().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("", port), MetricsHandler)
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info("serving metrics on port: {}".format(port))
+
+        if path:
+            Thread(target=self.write_periodically, daemon=True).start()
+
+    def get_metrics(self):
+        with self.pipeline.lock:
+            statistics = collections.Counter(self.pipeline.statistics)
+        return format_prometheus_metrics(self.program_name, statistics)
+
+    def write_metrics(self):
+        # the file is replaced at once, it is never read half written
+        temporary_path = self.path + ".tmp"
+        file = open(temporary_path, "w")
+        file.write(self.get_metrics())
+        file.close()
+        os.replace(temporary_path, self.path)
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write_metrics()
+
+    def stop(self):
+        self.stopped.set()
+        if self.path:
+            self.write_metrics()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class SampledStats:
+    # the statistics of the sampled stacks, in the format of the profiles of cprofile (the numbers of calls are numbers of
+    # samples)
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def get_code_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def get_code_label(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler:
+    # profiles every thread of the process, either deterministically (cprofile) or by sampling their stacks at a fixed
+    # interval (low overhead, it can be left on for a whole analysis). The stacks are sampled in both modes, they give the
+    # collapsed stacks of the flamegraphs
+    def __init__(self, mode, interval):
+        self.mode = mode
+        self.interval = interval
+        self.profiles = []
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        self.sampler = Thread(target=self.sample, name="profiler", daemon=True)
+        self.sampler.start()
+
+        if self.mode == "cprofile":
+            # only one profile can be active at a time since python 3.12, but it sees every thread
+            if sys.version_info < (3, 12):
+                threading.setprofile(self.profile_thread)
+            self.enable_profile()
+
+    def enable_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def profile_thread(self, frame, event, arg):
+        # called once by every new thread, the profile of the thread replaces this function
+        sys.setprofile(None)
+        self.enable_profile()
+
+    def sample(self):
+        sampler_id = threading.get_ident()
+        process_name = multiprocessing.current_process().name
+
+        while not self.stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+
+                # the stacks are rooted by their thread (and process)
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                root = thread_name if process_name == "MainProcess" else "{}/{}".format(process_name, thread_name)
+                self.samples[(root,) + tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.mode == "cprofile":
+            threading.setprofile(None)
+            self.profiles[0].disable()
+        self.sampler.join()
+
+    def get_stats(self):
+        if self.mode == "cprofile":
+            # merges the profiles of every thread
+            with self.lock:
+                profiles = list(self.profiles)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            return stats
+
+        stats = {}
+        for (root, *stack), count in self.samples.items():
+            if not stack:
+                continue
+
+            seconds = count * self.interval
+            keys = [get_code_key(code) for code in stack]
+
+            # the cumulative time of a function only counts once in a recursive stack
+            for key in set(keys):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+            stats[keys[-1]][2] += seconds
+
+            for caller, callee in set(zip(keys, keys[1:])):
+                callers = stats[callee][4]
+                caller_count, caller_calls, caller_time, caller_cumulative = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (caller_count + count, caller_calls + count, caller_time + (seconds if callee == keys[-1] else 0.0), caller_cumulative + seconds)
+
+        return pstats.Stats(SampledStats({key: tuple(entry) for key, entry in stats.items()}))
+
+    def get_collapsed_stacks(self):
+        collapsed = collections.Counter()
+        for (root, *stack), count in self.samples.items():
+            collapsed[";".join([root] + [get_code_label(code) for code in stack])] += count
+        return collapsed
+
+    def save(self, path):
+        self.stop()
+        self.get_stats().dump_stats(path + ".pstats")
+        save_collapsed_stacks(path + ".collapsed", self.get_collapsed_stacks())
+
+
+def save_collapsed_stacks(path, collapsed):
+    # one line per stack with its number of samples, as expected by flamegraph.pl or speedscope
+    file = open(path, "w")
+    for stack, count in sorted(collapsed.items()):
+        file.write("{} {}\n".format(stack, count))
+    file.close()
+
+
+def save_profile(profiler, path, processes_path):
+    # merges the profile of the main process with the ones saved by the analysis processes when they exited
+    profiler.stop()
+    stats = profiler.get_stats()
+    collapsed = profiler.get_collapsed_stacks()
+
+    if os.path.exists(processes_path):
+        for filename in sorted(os.listdir(processes_path)):
+            if filename.endswith(".pstats"):
+                stats.add(os.path.join(processes_path, filename))
+            elif filename.endswith(".collapsed"):
+                file = open(os.path.join(processes_path, filename))
+                for line in file:
+                    stack, count = line.rstrip("\n").rsplit(" ", 1)
+                    collapsed[stack] += int(count)
+                file.close()
+        shutil.rmtree(processes_path)
+
+    stats.dump_stats(path + ".pstats")
+    save_collapsed_stacks(path + ".collapsed", collapsed)
+    logger.info("saved profile to: {0}.pstats and {0}.collapsed".format(path))
+
+
+def initialize_process(use_debug_mode, log_filename, profile_mode="", profile_interval=0.01, profiles_path=""):
+    initialize_logger(use_debug_mode, log_filename)
+
+    # the analysis processes save their profile when they exit, the main process merges them
+    if profile_mode:
+        profiler = Profiler(profile_mode, profile_interval)
+        profiler.start()
+        Finalize(None, profiler.save, args=(os.path.join(profiles_path, str(os.getpid())),), exitpriority=10)
+
+
+class ProgressReporter:
+    # logs the progress of an analysis at regular intervals from its own thread, the workers only update a few counters
+    # (the total number of sources is known once they have all been listed, the total number of documents only if the
+    # api gives it), a source is in progress until it has been downloaded and all its analyses are done
+    def __init__(self, source_unit, document_unit, interval):
+        self.source_unit = source_unit
+        self.document_unit = document_unit
+        self.interval = interval
+        self.total_sources = None
+        self.total_documents = 0
+        # the number of sources whose total number of documents is known
+        self.counted_sources = 0
+        self.completed_sources = 0
+        self.documents = 0
+        self.pending_analyses = 0
+        # the start time and the number of unfinished tasks of the sources in progress
+        self.in_progress = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.last_documents = 0
+
+    def start(self):
+        if self.interval > 0:
+            Thread(target=self.run, name="progress", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def set_total_sources(self, total):
+        with self.lock:
+            self.total_sources = total
+
+    def add_total_documents(self, count):
+        with self.lock:
+            self.total_documents += count
+            self.counted_sources += 1
+
+    def add_documents(self, count=1):
+        with self.lock:
+            self.documents += count
+
+    def start_task(self, source):
+        with self.lock:
+            if source in self.in_progress:
+                self.in_progress[source][1] += 1
+            else:
+                self.in_progress[source] = [time.monotonic(), 1]
+
+    def finish_task(self, source):
+        with self.lock:
+            self.in_progress[source][1] -= 1
+            if not self.in_progress[source][1]:
+                del self.in_progress[source]
+                self.completed_sources += 1
+
+    def start_analysis(self, source):
+        with self.lock:
+            self.pending_analyses += 1
+        self.start_task(source)
+
+    def finish_analysis(self, source):
+        with self.lock:
+            self.pending_analyses -= 1
+        self.finish_task(source)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            total_sources = self.total_sources
+            total_documents = self.total_documents
+            counted_sources = self.counted_sources
+            completed_sources = self.completed_sources
+            documents = self.documents
+            pending_analyses = self.pending_analyses
+            num_in_progress = len(self.in_progress)
+            slowest = min(self.in_progress.items(), key=lambda item: item[1][0]) if self.in_progress else None
+
+        # the current rate is measured since the last report
+        rate = (documents - self.last_documents) / (now - self.last_time)
+        self.last_time = now
+        self.last_documents = documents
+
+        parts = ["{}/{} {} done".format(completed_sources, total_sources if total_sources is not None else "?", self.source_unit)]
+        if total_sources:
+            parts[0] += " ({:.1f}%)".format(100.0 * completed_sources / total_sources)
+        parts.append("{} in progress".format(num_in_progress))
+        if self.document_unit:
+            parts.append("{}{} {} downloaded ({:.1f}/s)".format(documents, "/{}".format(total_documents) if total_documents else "", self.document_unit, rate))
+        parts.append("{} analyses pending".format(pending_analyses))
+
+        # the remaining time is extrapolated from the share of the work done so far, counted in documents when their total
+        # is known (the sources not started yet are assumed to be as large as the others)
+        done = 0
+        if total_sources and total_documents:
+            done = min(documents * counted_sources / (total_documents * max(total_sources, counted_sources)), 1)
+        elif total_sources:
+            done = completed_sources / total_sources
+        if 0 < done < 1:
+            parts.append("eta: {}".format(datetime.timedelta(seconds=round((now - self.start_time) * (1 - done) / done))))
+
+        if slowest:
+            parts.append("slowest: {} for {}".format(slowest[0], datetime.timedelta(seconds=round(now - slowest[1][0]))))
+
+        logger.info("progress: {}".format(", ".join(parts)))
+
+
+class ScanPipeline:
+    # the downloads are handled by threads (i/o bound) while the analyses are handed over to a pool of processes (cpu
+    # bound), at most `max_pending_scans` analyses can be waiting: the downloads are blocked until the analyses catch up
+    def __init__(self, num_processes, max_pending_scans, use_debug_mode, log_filename, profile_mode="", profile_interval=0.01, profiles_path="", progress=None):
+        self.executor = None
+        self.progress = progress
+        self.pending_scans = threading.BoundedSemaphore(max_pending_scans)
+        self.futures = set()
+        self.failed_sources = set()
+        # the statistics returned by the analyses (if any)
+        self.statistics = collections.Counter()
+        self.lock = threading.Lock()
+
+        # without any process, the analyses are run by the downloading threads themselves
+        if num_processes > 0:
+            self.executor = ProcessPoolExecutor(num_processes, mp_context=multiprocessing.get_context("spawn"), initializer=initialize_process,
+                                                initargs=(use_debug_mode, log_filename, profile_mode, profile_interval, profiles_path))
+
+    def submit(self, source, function, *args):
+        if not self.executor:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+                self.on_failure(source, e)
+            else:
+                self.add_statistics(future.result())
+            return future
+
+        self.pending_scans.acquire()
+        if self.progress:
+            self.progress.start_analysis(source)
+
+        try:
+            future = self.executor.submit(function, *args)
+        except Exception:
+            self.pending_scans.release()
+            if self.progress:
+                self.progress.finish_analysis(source)
+            raise
+
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(lambda done_future: self.on_done(source, done_future))
+
+        return future
+
+    def on_done(self, source, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.pending_scans.release()
+
+        if future.exception() is not None:
+            self.on_failure(source, future.exception())
+        else:
+            self.add_statistics(future.result())
+
+        if self.progress:
+            self.progress.finish_analysis(source)
+
+    def add_statistics(self, statistics):
+        if statistics:
+            with self.lock:
+                self.statistics.update(statistics)
+
+    @contextlib.contextmanager
+    def measure(self, stage, source):
+        # measures a stage run by the downloading threads
+        statistics = collections.Counter()
+        try:
+            with measure_stage(statistics, stage, source):
+                yield
+        finally:
+            self.add_statistics(statistics)
+
+    def timed(self, stage, source, function):
+        # measures every call of a function, on behalf of the calling worker even if it is called by another thread (e.g. the
+        # background thread of a paginated api)
+        worker = get_worker_name()
+
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                statistics = collections.Counter()
+                observe_stage(statistics, stage, source, time.perf_counter() - start, worker)
+                self.add_statistics(statistics)
+
+        return timed_function
+
+    def on_failure(self, source, exception):
+        logger.error("couldn't analyze {}: {}".format(source, exception))
+        with self.lock:
+            self.failed_sources.add(source)
+
+    def join(self):
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+            if not futures:
+                break
+            concurrent.futures.wait(futures)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+
+
+class AdaptiveLimiter:
+    # limits the number of concurrent requests with an additive increase / multiplicative decrease of the limit: it grows
+    # by one every round of successful requests and is halved when the server throttles or slows down
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = 1.0
+        self.in_flight = 0
+        self.paused_until = 0
+        # the latency of each endpoint (e.g. listing the spaces is much faster than downloading pages) is compared to its
+        # own baseline: [number of samples since the last decrease, recent latency, baseline latency]
+        self.latencies = {}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self, latency, throttled, endpoint=""):
+        with self.condition:
+            self.in_flight -= 1
+
+            slowed_down = False
+            if latency is not None:
+                samples = self.latencies.setdefault(endpoint, [0, None, latency])
+                samples[0] += 1
+                samples[1] = latency if samples[1] is None else 0.8 * samples[1] + 0.2 * latency
+                # the baseline follows the latency slowly, this way a few fast requests don't make every later one look slow
+                samples[2] = 0.98 * samples[2] + 0.02 * latency
+                slowed_down = samples[0] >= min_latency_samples and samples[1] > 4 * samples[2] + 0.1
+
+            # the server is saturated when it throttles the requests or when its latency explodes
+            if throttled or slowed_down:
+                self.decrease()
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def decrease(self):
+        previous_limit = int(self.limit)
+        self.limit = max(1.0, self.limit / 2)
+        # the latency is measured again at the new concurrency, the requests sent before the decrease are not enough to
+        # decrease it again
+        for samples in self.latencies.values():
+            samples[0] = 0
+            samples[1] = None
+        if int(self.limit) != previous_limit:
+            logger.debug("reducing the number of concurrent requests to {}".format(int(self.limit)))
+
+    def pause(self, delay):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+class AdaptiveAdapter(HTTPAdapter):
+    def __init__(self, max_connections, max_retries=5, max_retry_delay=300):
+        HTTPAdapter.__init__(self, pool_connections=max_connections, pool_maxsize=max_connections, pool_block=True)
+        self.limiter = AdaptiveLimiter(max_connections)
+        self.max_request_retries = max_retries
+        self.max_retry_delay = max_retry_delay
+
+    def send(self, request, **kwargs):
+        attempt = 0
+
+        while True:
+            self.limiter.acquire()
+            time_before_request = time.monotonic()
+
+            try:
+                response = HTTPAdapter.send(self, request, **kwargs)
+            except Exception:
+                self.limiter.release(None, True)
+                raise
+
+            throttled = response.status_code in (429, 503)
+            self.limiter.release(time.monotonic() - time_before_request, throttled, get_endpoint(request.url))
+
+            if not throttled or attempt >= self.max_request_retries:
+                return response
+
+            # every request waits for the delay asked by the server (or an exponential backoff if it didn't ask for one)
+            delay = min(get_retry_after(response, 2 ** attempt), self.max_retry_delay)
+            logger.debug("request throttled by the server, retrying in {:.1f}s: {}".format(delay, request.url))
+            self.limiter.pause(delay)
+            response.close()
+            attempt += 1
+
+
+def get_endpoint(url):
+    # the requests for different ids (e.g. pages or issues) are sent to the same endpoint
+    return re.sub(r"\d+", "*", urllib.parse.urlsplit(url).path)
+
+
+def get_retry_after(response, default):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return default
+
+    # the delay can either be a number of seconds or a date
+    if retry_after.strip().isdigit():
+        return int(retry_after)
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def create_session(max_connections):
+    # a session shared by every thread, with a pool of keep-alive connections and an adaptive concurrency
+    session = Session()
+    adapter = AdaptiveAdapter(max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -28,67 +28,124 @@ logger = logging.getLogger(program_name)
 file_filters_re = []
 # the compiled regex of content filters
 content_filters_re = []
+# the context given to every analysis
+scan_context = None
+# the pipeline handing the downloaded pages over to the analysis processes
+pipeline = None
+# logs the progress of the analysis at regular intervals
+progress = None
+# the state of the previous analyses (used by incremental analyses)
+state = {}
+# the time at which the analysis started
+analysis_start = None
 
 
 class AnalysisWorker(Thread):
     def __init__(self, queue, unique_id):
-        Thread.__init__(self)
+        Thread.__init__(self, name="worker-{}".format(unique_id))
         self.queue = queue
         self.unique_id = unique_id
 
     def run(self):
         while True:
-            # gets a task if there are any (which contains an ssh url to the repo)
+            # gets a task if there are any (which contains the space to download)
             (name, account, key, downloads_path, results_path, gitleaks_results_path) = self.queue.get()
 
+            progress.start_task(key)
+            try:
+                self.download_space(name, account, key, downloads_path, results_path, gitleaks_results_path)
+            except Exception as e:
+                # the space will be analyzed again by the next analysis, the thread goes on with the next one
+                pipeline.on_failure(key, e)
+            finally:
+                progress.finish_task(key)
+
+                # notify the queue handler that the task is done
+                self.queue.task_done()
+
+    def download_space(self, name, account, key, downloads_path, results_path, gitleaks_results_path):
+        space_state = state["spaces"].get(key)
+
+        # the pages which haven't been modified still need to be analyzed again if the rules or filters have changed
+        is_incremental = config["incremental"] and space_state and space_state.get("analysis") == scan_context.analysis_hash
+
+        if is_incremental:
+            # lists the pages of the space without their content to find out which ones have been deleted
+            page_ids = get_page_ids(account, key)
+            known_page_ids = set(space_state["pages"])
+
+            # removes the results of the pages which have been deleted (or moved to another space)
+            for page_id in known_page_ids - page_ids:
+                logger.debug("removing results of deleted page: {}".format(page_id))
+                common.remove_document_results(page_id, downloads_path, results_path, gitleaks_results_path, scan_context.get_results_store())
+
+            # only gets the pages created or modified since the last analysis of the space
+            last_analysis = datetime.datetime.fromisoformat(space_state["last_analysis"])
+            pages = get_modified_pages(account, key, last_analysis - common.incremental_overlap, page_ids - known_page_ids)
+        else:
             # gets all the pages of the space
-            pages = account.get_all_pages_from_space(key, limit=99999, expand="body.storage")
+            pages = common.paginate(pipeline.timed("fetch", key, lambda start, limit: account.get_all_pages_from_space(key, start=start, limit=limit, expand="body.storage")),
+                                    config["page_size"])
+            page_ids = set()
 
-            # analyze each pages of the space
-            for page in pages:
-                page_path = "{}{}.html".format(downloads_path, page["id"])
+        # the pages waiting to be analyzed in the next gitleaks batch
+        pending_pages = []
+
+        # download each pages of the space
+        for page in pages:
+            page_ids.add(page["id"])
+            progress.add_documents()
+
+            page_path = "{}{}.html".format(downloads_path, page["id"])
+            with pipeline.measure("write", key):
                 file = open(page_path, "w")
                 file.write(page["body"]["storage"]["value"])
                 file.close()
 
-                log_file_path = "{}{}.log".format(gitleaks_results_path, page["id"])
+            log_file_path = "{}{}.log".format(gitleaks_results_path, page["id"])
+
+            if not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
+                pending_pages.append(common.Document(page["id"], page_path, log_file_path, "{}{}.csv".format(results_path, page["id"]),
+                                                     "{}spaces/{}/pages/{}/".format(config["url"], key, page["id"]), key))
+
+                # hands the pages over to the analysis processes by chunks if a batch size is defined
+                if config["scan_batch_size"] and len(pending_pages) >= config["scan_batch_size"]:
+                    pipeline.submit(key, common.analyze_documents, scan_context, pending_pages, downloads_path)
+                    pending_pages = []
 
-                if not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
-                    # checks for leak using gitleaks and store the logs in a stream
-                    gitleaks_logs = common.run_gitleaks(page_path)
+        # hands the remaining pages of the space over
+        if pending_pages:
+            pipeline.submit(key, common.analyze_documents, scan_context, pending_pages, downloads_path)
 
-                    # if the logs are not empty, save them in a file
-                    # else, remove the file (we have fixed all the leaks)
-                    if gitleaks_logs:
-                        log_file = open(log_file_path, "w")
-                        log_file.write(gitleaks_logs)
-                        log_file.close()
-                    elif os.path.exists(log_file_path):
-                        os.path.realpath(log_file_path)
+        # removes the results of the pages which have been deleted since the last analysis of the space
+        if not is_incremental and space_state:
+            for page_id in set(space_state["pages"]) - page_ids:
+                logger.debug("removing results of deleted page: {}".format(page_id))
+                common.remove_document_results(page_id, downloads_path, results_path, gitleaks_results_path, scan_context.get_results_store())
 
-                    # deserialize the gitleaks logs
-                    leaks = common.deserialize_gitleaks(log_file_path, file_filters_re, content_filters_re)
+        # the next incremental analysis of the space will start from here
+        state["spaces"][key] = {"last_analysis": analysis_start.isoformat(), "analysis": scan_context.analysis_hash, "pages": sorted(page_ids)}
 
-                    # defines the path of the processed csv file
-                    processed_log_file_path = "{}{}.csv".format(results_path, page["id"])
 
-                    # convert from gitleaks format to csv format
-                    csv = common.gitleaks_to_csv(leaks, page["id"])
+def get_page_ids(account, key):
+    pages = common.paginate(pipeline.timed("list", key, lambda start, limit: account.get_all_pages_from_space(key, start=start, limit=limit)), config["page_size"])
+    return set(page["id"] for page in pages)
 
-                    # load the last generated csv file if it exists to export the comments to te new one
-                    old_csv = common.deserialize_csv(processed_log_file_path)
-                    for line in csv:
-                        for old_line in old_csv:
-                            # if it seems to be the same secret in the same file, we assume they should have the same comment
-                            if old_line.comment and line.secret == old_line.secret and line.file == old_line.file:
-                                line.comment = old_line.comment
-                                break
 
-                    # serialize the csv into a file
-                    common.serialize_csv(processed_log_file_path, csv, "{}spaces/{}/pages/{}/".format(config["url"], key, page["id"]))
+def get_modified_pages(account, key, since, new_page_ids):
+    cql = 'space = "{}" and type = page and lastmodified >= "{}"'.format(key, since.strftime("%Y-%m-%d %H:%M"))
+    modified_page_ids = set()
 
-            # notify the queue handler that the task is done
-            self.queue.task_done()
+    search = pipeline.timed("fetch", key, lambda start, limit: account.cql(cql, start=start, limit=limit, expand="content.body.storage")["results"])
+    for result in common.paginate(search, config["page_size"]):
+        modified_page_ids.add(result["content"]["id"])
+        yield result["content"]
+
+    # the pages new to the space which haven't been modified (e.g. moved from another space or restored from the trash)
+    for page_id in new_page_ids - modified_page_ids:
+        with pipeline.measure("fetch", key):
+            page = account.get_page_by_id(page_id, expand="body.storage")
+        yield page
 
 
 def print_help():
@@ -105,7 +162,11 @@ def print_help():
     logger.info("\t-u, --username     username of your atlassian account")
     logger.info("\t-p, --password     password (or application password for maximum security) of your atlassian account")
     logger.info("\t-o, --output       output path that will be used for cloning and analyzing")
-    logger.info("\t-t, --threads      number of threads to use for parallel analysis")
+    logger.info("\t-t, --threads      number of threads to use for parallel downloads")
+    logger.info("\t-j, --processes    number of processes to use for parallel analysis (0 analyzes within the download threads)")
+    logger.info("\t-i, --incremental  only analyzes the pages created, modified or deleted since the last analysis of the output path")
+    logger.info("\t    --profile      profiles every thread and process of the analysis (saved as profile.pstats and profile.collapsed)")
+    logger.info("\t    --sampling     profiles by sampling the stacks instead, with a low overhead")
     logger.info("\t-V, --verbose      enables the debug logging mode")
     logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
     logger.info("\t-h, --help         shows this help message and exits")
@@ -117,7 +178,7 @@ def print_version():
 
 
 def main(argv):
-    global config, file_filters_re, content_filters_re
+    global config, file_filters_re, content_filters_re, scan_context, pipeline, progress, state, analysis_start
 
     save_config_path = ""
     do_not_use_port = False
@@ -128,7 +189,8 @@ def main(argv):
 
     try:
         # getopt is used to define the list of options the program should accept
-        opts, args = getopt.getopt(argv, "c:s:U:P:u:p:o:t:Vl:hv", ["config=", "save=", "url=", "port=", "username=", "password=", "output=", "threads=", "verbose", "log=", "help", "version"])
+        opts, args = getopt.getopt(argv, "c:s:U:P:u:p:o:t:j:iVl:hv", ["config=", "save=", "url=", "port=", "username=", "password=", "output=", "threads=", "processes=", "incremental",
+                                                                      "profile", "sampling", "verbose", "log=", "help", "version"])
 
         filename = ""
         use_debug_mode = False
@@ -174,6 +236,17 @@ def main(argv):
                     config["num_threads"] = int(arg)
                 else:
                     logger.error("the number of threads must be a numeric value!")
+            elif opt in ("-j", "--processes"):
+                if arg.isnumeric():
+                    config["num_processes"] = int(arg)
+                else:
+                    logger.error("the number of processes must be a numeric value!")
+            elif opt == "--profile":
+                config["profile"] = "cprofile"
+            elif opt == "--sampling":
+                config["profile"] = "sampling"
+            elif opt in ("-i", "--incremental"):
+                config["incremental"] = True
 
         # checks if the necessary settings have been provided
         if ("url" not in config or not config["url"]) or \
@@ -191,6 +264,15 @@ def main(argv):
         config["do_not_renew_analysis"] = False
     if "do_not_update_docs" not in config:
         config["do_not_update_docs"] = False
+    if "incremental" not in config:
+        config["incremental"] = False
+    # number of pages analyzed by each gitleaks run (0 analyzes a whole space at once)
+    if "scan_batch_size" not in config:
+        config["scan_batch_size"] = 500
+    # number of pages downloaded by each request
+    if "page_size" not in config:
+        config["page_size"] = 100
+    # the spaces to analyze or exclude, by key (either glob patterns, or regex patterns prefixed by "re:")
     if "whitelist" not in config:
         config["whitelist"] = []
     if "blacklist" not in config:
@@ -199,18 +281,72 @@ def main(argv):
         config["file_filters"] = []
     if "content_filters" not in config:
         config["content_filters"] = []
+    if "do_not_use_cache" not in config:
+        config["do_not_use_cache"] = False
+    # engine analyzing the sources: "gitleaks" runs gitleaks, "python" analyzes them within the analysis processes with
+    # the rules of gitleaks' configuration
+    if "scan_engine" not in config or config["scan_engine"] not in ("gitleaks", "python"):
+        config["scan_engine"] = "gitleaks"
+    # the default rules of gitleaks used by the python engine (downloaded for the installed version of gitleaks if none)
+    if "default_rules_path" not in config:
+        config["default_rules_path"] = ""
+    # skips the pages which don't contain any keyword of the rules before running the analysis (needs the default rules,
+    # as for the python engine)
+    if "use_prefilter" not in config:
+        config["use_prefilter"] = False
+    # stores the results in a single database instead of a csv file per source (see results_db.py to query or export them)
+    if "use_results_db" not in config:
+        config["use_results_db"] = False
+    # maximum number of analyses kept in the cache (the least recently used are evicted first)
+    if "cache_max_entries" not in config:
+        config["cache_max_entries"] = 1000000
     if "port" not in config:
         do_not_use_port = True
     # find the number of thread to use for the multithreading if none is defined (by default, the number of cpu cores
     # for maximum profitability)
-    if "num_threads" not in config or not config["num_threads"].isnumeric() or config["num_threads"] <= 0:
+    if "num_threads" not in config or not isinstance(config["num_threads"], int) or config["num_threads"] <= 0:
         config["num_threads"] = multiprocessing.cpu_count()
+    # maximum number of concurrent requests to the server (the actual number adapts to the server's load)
+    if "max_connections" not in config or not isinstance(config["max_connections"], int) or config["max_connections"] <= 0:
+        config["max_connections"] = 16
+    # same for the number of processes running the analyses
+    if "num_processes" not in config or not isinstance(config["num_processes"], int) or config["num_processes"] < 0:
+        config["num_processes"] = multiprocessing.cpu_count()
+    # number of analyses which can wait for a process before the downloads are paused
+    if "max_pending_scans" not in config or not isinstance(config["max_pending_scans"], int) or config["max_pending_scans"] <= 0:
+        config["max_pending_scans"] = 2 * max(config["num_processes"], 1)
     # if no output path was specified, use a predefined value (e.g. "./workspace_2022-11-14_15-19-23/")
     if "path" not in config or not config["path"]:
         # todo: format based on domain name
         config["path"] = "./{}_{}/".format("confluence", datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
     elif not config["path"].endswith("/"):
         config["path"] += "/"
+    # the cache is kept within the output path by default, it can be shared between outputs
+    if "cache_path" not in config or not config["cache_path"]:
+        config["cache_path"] = config["path"] + "cache.sqlite"
+    if "results_db_path" not in config or not config["results_db_path"]:
+        config["results_db_path"] = config["path"] + "results.sqlite"
+    # the json report of the analysis: time spent in each stage (histograms), by source and by worker
+    if "run_report_path" not in config or not config["run_report_path"]:
+        config["run_report_path"] = config["path"] + "run_report.json"
+    # exposes the metrics of a long analysis in the prometheus text format, through a file rewritten every
+    # `metrics_interval` seconds and/or an http endpoint (0 to disable it)
+    if "metrics_path" not in config:
+        config["metrics_path"] = ""
+    if "metrics_port" not in config or not isinstance(config["metrics_port"], int) or config["metrics_port"] < 0:
+        config["metrics_port"] = 0
+    # profiles the analysis: "cprofile" (deterministic) or "sampling" (the stacks of every thread are sampled every
+    # `profile_interval` seconds), the profiles of every thread and process are merged in the output path
+    if "profile" not in config or config["profile"] not in ("cprofile", "sampling"):
+        config["profile"] = ""
+    if "profile_interval" not in config or not isinstance(config["profile_interval"], (int, float)) or config["profile_interval"] <= 0:
+        config["profile_interval"] = 0.01
+    if "metrics_interval" not in config or not isinstance(config["metrics_interval"], (int, float)) or config["metrics_interval"] <= 0:
+        config["metrics_interval"] = 15
+    # logs the spaces and pages done, the download rate, an eta and the slowest space every `progress_interval` seconds
+    # (0 to disable it)
+    if "progress_interval" not in config or not isinstance(config["progress_interval"], (int, float)) or config["progress_interval"] < 0:
+        config["progress_interval"] = 60
     if not config["url"].startswith("http"):
         config["url"] = "https://" + config["url"]
     if config["url"].endswith("/"):
@@ -221,11 +357,12 @@ def main(argv):
     results_path = config["path"] + "results/"
     gitleaks_results_path = config["path"] + "gitleaks/"
     downloads_path = config["path"] + "downloads/"
+    state_path = config["path"] + "state.json"
 
     # connecting to Atlassian account (either through account password or application password)
     logger.debug("connecting to account...")
     url = config["url"] if do_not_use_port else "{}:{}".format(config["url"], config["port"])
-    account = Confluence(url=url, username=config["username"], password=config["password"], cloud=True)
+    account = Confluence(url=url, username=config["username"], password=config["password"], cloud=True, session=common.create_session(config["max_connections"]))
     logger.info("connected to account: {}".format(config["username"]))
 
     # creates the directory in which the analysis will take place if it doesn't exist
@@ -244,15 +381,68 @@ def main(argv):
         os.mkdir(downloads_path)
 
     logger.debug("compiling regex filters...")
+    whitelist_re = common.compile_source_patterns(config["whitelist"])
+    blacklist_re = common.compile_source_patterns(config["blacklist"])
     for file_filter in config["file_filters"]:
         file_filters_re.append(re.compile(file_filter))
     for content_filter in config["content_filters"]:
         content_filters_re.append(re.compile(content_filter))
 
+    default_rules_path = config["default_rules_path"]
+    use_prefilter = config["use_prefilter"]
+    if config["scan_engine"] == "python" or use_prefilter:
+        try:
+            default_rules_path = common.load_engine_rules(default_rules_path, config["path"], config["scan_engine"])
+        except Exception as e:
+            if config["scan_engine"] == "python":
+                logger.critical("couldn't load the rules of the python engine: {}".format(e))
+                sys.exit(1)
+
+            # the prefilter is only an optimization, the analysis goes on without it
+            logger.error("couldn't load the rules of the prefilter, it is disabled: {}".format(e))
+            use_prefilter = False
+
+    scan_context = common.ScanContext(file_filters_re, content_filters_re, "" if config["do_not_use_cache"] else config["cache_path"],
+                                      common.get_rules_hash(config["scan_engine"], default_rules_path), config["cache_max_entries"],
+                                      config["results_db_path"] if config["use_results_db"] else "", config["scan_engine"], default_rules_path,
+                                      use_prefilter)
+
+    # opens the cache before any analysis (it gets invalidated if the rules have changed)
+    logger.debug("opening scan cache...")
+    scan_cache = scan_context.get_scan_cache()
+    results_store = scan_context.get_results_store()
+
+    # loads the state of the previous analyses
+    state = common.load_state(state_path)
+    if "spaces" not in state:
+        state["spaces"] = {}
+    previous_state = dict(state["spaces"])
+    if config["incremental"] and not state["spaces"]:
+        logger.warning("no previous analysis found in the output path, every page will be analyzed")
+
     # takes the time before analysis (for statistics)
     time_before_analysis = time.time()
-
-    # creates the queue of repo to analyze by the worker threads
+    analysis_start = datetime.datetime.now(datetime.timezone.utc)
+
+    # creates the pipeline running the analyses of the downloaded pages
+    # the profiler is started before any worker thread, so that every one of them is profiled
+    profiler = None
+    profiles_path = config["path"] + "profiles/"
+    if config["profile"]:
+        if not os.path.exists(profiles_path):
+            os.mkdir(profiles_path)
+        profiler = common.Profiler(config["profile"], config["profile_interval"])
+        profiler.start()
+
+    progress = common.ProgressReporter("spaces", "pages", config["progress_interval"])
+    pipeline = common.ScanPipeline(config["num_processes"], config["max_pending_scans"], use_debug_mode, filename, config["profile"], config["profile_interval"],
+                                   profiles_path, progress)
+    metrics_exporter = None
+    if config["metrics_path"] or config["metrics_port"]:
+        metrics_exporter = common.MetricsExporter(program_name, pipeline, config["metrics_path"], config["metrics_port"], config["metrics_interval"])
+    progress.start()
+
+    # creates the queue of spaces to download by the worker threads
     work_queue = Queue()
 
     # launch as much worker threads as specified by `num_worker_threads`
@@ -266,24 +456,64 @@ def main(argv):
         i += 1
 
     logger.debug("adding analysis tasks...")
-    spaces = account.get_all_spaces(limit=99999)
+    num_excluded_spaces = 0
+    with pipeline.measure("list", ""):
+        spaces = account.get_all_spaces(limit=99999)
     for space in spaces["results"]:
         key = space["key"]
         name = space["name"]
+
+        # the excluded spaces are never downloaded
+        if not common.is_source_included(key, whitelist_re, blacklist_re):
+            num_excluded_spaces += 1
+            continue
+
         work_queue.put((name, account, key, downloads_path, results_path, gitleaks_results_path))
 
+    logger.info("excluded {} spaces through the whitelist and blacklist".format(num_excluded_spaces))
+    progress.set_total_sources(len(spaces["results"]) - num_excluded_spaces)
+
     # wait for all tasks to finish
     work_queue.join()
+    pipeline.join()
+    pipeline.shutdown()
+    progress.stop()
+
+    # the spaces which couldn't be fully analyzed will be analyzed again by the next incremental analysis
+    for key in pipeline.failed_sources:
+        if key in previous_state:
+            state["spaces"][key] = previous_state[key]
+        else:
+            state["spaces"].pop(key, None)
 
     # saves the time after analysis and shows the time spent analyzing for statistics
     time_after_analysis = time.time()
     logger.info('time spent analyzing: %.2fs', time_after_analysis - time_before_analysis)
+    common.log_filter_statistics(pipeline.statistics, config["file_filters"], config["content_filters"])
+    common.log_prefilter_statistics(pipeline.statistics, "pages")
+
+    # the time spent in each stage of the analysis
+    common.log_stage_metrics(pipeline.statistics)
+    common.save_run_report(config["run_report_path"], common.create_run_report(program_name, pipeline.statistics, analysis_start,
+                                                                               datetime.datetime.now(datetime.timezone.utc), len(spaces["results"]) - num_excluded_spaces, pipeline.failed_sources))
+    if metrics_exporter:
+        metrics_exporter.stop()
+    if profiler:
+        common.save_profile(profiler, config["path"] + "profile", profiles_path)
+
+    # saves the state for the next incremental analysis
+    common.save_state(state_path, state)
 
     if save_config_path:
         save_config_file = open(save_config_path, "w")
         save_config_file.write(json.dumps(config, indent=4))
         save_config_file.close()
 
+    if scan_cache:
+        scan_cache.close()
+    if results_store:
+        results_store.close()
+
     # close the atlassian account
     account.close()
 
@@ -32,88 +32,122 @@ logger = logging.getLogger(program_name)
 file_filters_re = []
 # the compiled regex of content filters
 content_filters_re = []
+# the context given to every analysis
+scan_context = None
+# the pipeline handing the downloaded issues over to the analysis processes
+pipeline = None
+# logs the progress of the analysis at regular intervals
+progress = None
+# the state of the previous analyses (used by incremental analyses)
+state = {}
+# the time at which the analysis started
+analysis_start = None
 
 
 class AnalysisWorker(Thread):
     def __init__(self, queue, unique_id):
-        Thread.__init__(self)
+        Thread.__init__(self, name="worker-{}".format(unique_id))
         self.queue = queue
         self.unique_id = unique_id
 
     def run(self):
         while True:
-            # gets a task if there are any (which contains an ssh url to the repo)
+            # gets a task if there are any (which contains the project to download)
             (name, account, key, downloads_path, results_path, gitleaks_results_path) = self.queue.get()
 
+            progress.start_task(key)
             try:
-                issues = []
-                i = 0
-
-                while True:
-                    issues_tmp = account.get_all_project_issues(key, start=i, limit=100, fields=["description", "summary"])
-                    issues += issues_tmp
-                    i += len(issues_tmp)
-                    if len(issues_tmp) < 100:
-                        break
-
-                # analyze each pages of the space
-                for issue in issues:
-                    comments = account.issue_get_comments(issue["key"])
-
-                    page_path = "{}{}.html".format(downloads_path, issue["key"])
+                self.download_project(name, account, key, downloads_path, results_path, gitleaks_results_path)
+            except Exception as e:
+                # the project will be analyzed again by the next analysis, the thread goes on with the next one
+                pipeline.on_failure(key, e)
+            finally:
+                progress.finish_task(key)
+
+                # notify the queue handler that the task is done
+                self.queue.task_done()
+
+    def download_project(self, name, account, key, downloads_path, results_path, gitleaks_results_path):
+        try:
+            project_state = state["projects"].get(key)
+
+            # the issues which haven't been updated still need to be analyzed again if the rules or filters have changed
+            if config["incremental"] and project_state and project_state.get("analysis") == scan_context.analysis_hash:
+                # only gets the issues updated since the last analysis of the project (adding a comment to an issue
+                # also updates it)
+                since = datetime.datetime.fromisoformat(project_state["last_analysis"]) - common.incremental_overlap
+                jql = 'project = "{}" AND updated >= "{}" ORDER BY key'.format(key, since.strftime("%Y/%m/%d %H:%M"))
+            else:
+                # gets all the issues of the project
+                jql = 'project = "{}" ORDER BY key'.format(key)
+
+            # gets the issues page by page, along with their comments (the first page gives the number of issues to
+            # download)
+            def search_issues(start, limit):
+                response = account.jql(jql, start=start, limit=limit, fields=["description", "summary", "comment"])
+                if start == 0:
+                    progress.add_total_documents(response.get("total", 0))
+                return response["issues"]
+
+            search = pipeline.timed("fetch", key, search_issues)
+            issues = common.paginate(search, config["page_size"])
+
+            # the issues waiting to be analyzed in the next gitleaks batch
+            pending_issues = []
+
+            # download each issues of the project
+            for issue in issues:
+                progress.add_documents()
+                # the comments are embedded in the issues, only the issues with more comments than the embedded ones
+                # need another request
+                comments = issue["fields"]["comment"]["comments"]
+                if issue["fields"]["comment"]["total"] > len(comments):
+                    with pipeline.measure("fetch", key):
+                        comments = get_issue_comments(account, issue["key"])
+
+                page_path = "{}{}.html".format(downloads_path, issue["key"])
+                with pipeline.measure("write", key):
                     file = open(page_path, "w")
                     file.write(issue["fields"]["summary"] + "\n")
                     if issue["fields"]["description"] is not None:
                         file.write(issue["fields"]["description"] + "\n")
                     file.write("\n")
-                    for comment in comments["comments"]:
+                    for comment in comments:
                         file.write(comment["body"] + "\n\n")
                     file.close()
 
-                    log_file_path = "{}{}.log".format(gitleaks_results_path, issue["key"])
+                log_file_path = "{}{}.log".format(gitleaks_results_path, issue["key"])
 
-                    if not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
-                        # checks for leak using gitleaks and store the logs in a stream
-                        try:
-                            gitleaks_logs = common.run_gitleaks(page_path)
-                        except:
-                            gitleaks_logs = ""
+                if not config["do_not_renew_analysis"] or not os.path.exists(log_file_path):
+                    pending_issues.append(common.Document(issue["key"], page_path, log_file_path, "{}{}.csv".format(results_path, issue["key"]),
+                                                          "{}/browse/{}/".format(config["url"], issue["key"]), key))
 
-                        # if the logs are not empty, save them in a file
-                        # else, remove the file (we have fixed all the leaks)
-                        if gitleaks_logs:
-                            log_file = open(log_file_path, "w")
-                            log_file.write(gitleaks_logs)
-                            log_file.close()
-                        elif os.path.exists(log_file_path):
-                            os.path.realpath(log_file_path)
+                    # hands the issues over to the analysis processes by chunks if a batch size is defined
+                    if config["scan_batch_size"] and len(pending_issues) >= config["scan_batch_size"]:
+                        pipeline.submit(key, common.analyze_documents, scan_context, pending_issues, downloads_path)
+                        pending_issues = []
 
-                        # deserialize the gitleaks logs
-                        leaks = common.deserialize_gitleaks(log_file_path, file_filters_re, content_filters_re)
+            # hands the remaining issues of the project over
+            if pending_issues:
+                pipeline.submit(key, common.analyze_documents, scan_context, pending_issues, downloads_path)
 
-                        # defines the path of the processed csv file
-                        processed_log_file_path = "{}{}.csv".format(results_path, issue["key"])
+            # the next incremental analysis of the project will start from here
+            state["projects"][key] = {"last_analysis": analysis_start.isoformat(), "analysis": scan_context.analysis_hash}
 
-                        # convert from gitleaks format to csv format
-                        csv = common.gitleaks_to_csv(leaks, issue["key"])
+        except HTTPError as e:
+            logger.error(e)
 
-                        # load the last generated csv file if it exists to export the comments to te new one
-                        old_csv = common.deserialize_csv(processed_log_file_path)
-                        for line in csv:
-                            for old_line in old_csv:
-                                # if it seems to be the same secret in the same file, we assume they should have the same comment
-                                if old_line.comment and line.secret == old_line.secret and line.file == old_line.file:
-                                    line.comment = old_line.comment
-                                    break
 
-                        # serialize the csv into a file
-                        common.serialize_csv(processed_log_file_path, csv, "{}/browse/{}/".format(config["url"], issue["key"]))
+def get_issue_comments(account, issue_key):
+    comments = []
 
-            except HTTPError as e:
-                logger.error(e)
+    while True:
+        response = account.get("rest/api/2/issue/{}/comment".format(issue_key), params={"startAt": len(comments), "maxResults": 100})
+        comments += response["comments"]
+        if not response["comments"] or len(comments) >= response["total"]:
+            break
 
-            # notify the queue handler that the task is done
-            self.queue.task_done()
+    return comments
 
 
 def print_help():
@@ -130,7 +164,11 @@ def print_help():
     logger.info("\t-u, --username     username of your atlassian account")
     logger.info("\t-p, --password     password (or application password for maximum security) of your atlassian account")
     logger.info("\t-o, --output       output path that will be used for cloning and analyzing")
-    logger.info("\t-t, --threads      number of threads to use for parallel analysis")
+    logger.info("\t-t, --threads      number of threads to use for parallel downloads")
+    logger.info("\t-j, --processes    number of processes to use for parallel analysis (0 analyzes within the download threads)")
+    logger.info("\t-i, --incremental  only analyzes the issues updated since the last analysis of the output path")
+    logger.info("\t    --profile      profiles every thread and process of the analysis (saved as profile.pstats and profile.collapsed)")
+    logger.info("\t    --sampling     profiles by sampling the stacks instead, with a low overhead")
     logger.info("\t-V, --verbose      enables the debug logging mode")
     logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
     logger.info("\t-h, --help         shows this help message and exits")
@@ -142,7 +180,7 @@ def print_version():
 
 
 def main(argv):
-    global config, file_filters_re, content_filters_re
+    global config, file_filters_re, content_filters_re, scan_context, pipeline, progress, state, analysis_start
 
     save_config_path = ""
     do_not_use_port = False
@@ -153,7 +191,8 @@ def main(argv):
 
     try:
         # getopt is used to define the list of options the program should accept
-        opts, args = getopt.getopt(argv, "c:s:U:P:u:p:o:t:Vl:hv", ["config=", "save=", "url=", "port=", "username=", "password=", "output=", "threads=", "verbose", "log=", "help", "version"])
+        opts, args = getopt.getopt(argv, "c:s:U:P:u:p:o:t:j:iVl:hv", ["config=", "save=", "url=", "port=", "username=", "password=", "output=", "threads=", "processes=", "incremental",
+                                                                      "profile", "sampling", "verbose", "log=", "help", "version"])
 
         filename = ""
         use_debug_mode = False
@@ -199,6 +238,17 @@ def main(argv):
                     config["num_threads"] = int(arg)
                 else:
                     logger.error("the number of threads must be a numeric value!")
+            elif opt in ("-j", "--processes"):
+                if arg.isnumeric():
+                    config["num_processes"] = int(arg)
+                else:
+                    logger.error("the number of processes must be a numeric value!")
+            elif opt == "--profile":
+                config["profile"] = "cprofile"
+            elif opt == "--sampling":
+                config["profile"] = "sampling"
+            elif opt in ("-i", "--incremental"):
+                config["incremental"] = True
 
         # checks if the necessary settings have been provided
         if ("url" not in config or not config["url"]) or \
@@ -216,6 +266,15 @@ def main(argv):
         config["do_not_renew_analysis"] = False
     if "do_not_update_docs" not in config:
         config["do_not_update_docs"] = False
+    if "incremental" not in config:
+        config["incremental"] = False
+    # number of issues analyzed by each gitleaks run (0 analyzes a whole project at once)
+    if "scan_batch_size" not in config:
+        config["scan_batch_size"] = 500
+    # number of issues downloaded by each request
+    if "page_size" not in config:
+        config["page_size"] = 100
+    # the projects to analyze or exclude, by key (either glob patterns, or regex patterns prefixed by "re:")
     if "whitelist" not in config:
         config["whitelist"] = []
     if "blacklist" not in config:
@@ -224,18 +283,72 @@ def main(argv):
         config["file_filters"] = []
     if "content_filters" not in config:
         config["content_filters"] = []
+    if "do_not_use_cache" not in config:
+        config["do_not_use_cache"] = False
+    # engine analyzing the sources: "gitleaks" runs gitleaks, "python" analyzes them within the analysis processes with
+    # the rules of gitleaks' configuration
+    if "scan_engine" not in config or config["scan_engine"] not in ("gitleaks", "python"):
+        config["scan_engine"] = "gitleaks"
+    # the default rules of gitleaks used by the python engine (downloaded for the installed version of gitleaks if none)
+    if "default_rules_path" not in config:
+        config["default_rules_path"] = ""
+    # skips the issues which don't contain any keyword of the rules before running the analysis (needs the default rules,
+    # as for the python engine)
+    if "use_prefilter" not in config:
+        config["use_prefilter"] = False
+    # stores the results in a single database instead of a csv file per source (see results_db.py to query or export them)
+    if "use_results_db" not in config:
+        config["use_results_db"] = False
+    # maximum number of analyses kept in the cache (the least recently used are evicted first)
+    if "cache_max_entries" not in config:
+        config["cache_max_entries"] = 1000000
     if "port" not in config:
         do_not_use_port = True
     # find the number of thread to use for the multithreading if none is defined (by default, the number of cpu cores
     # for maximum profitability)
-    if "num_threads" not in config or not config["num_threads"].isnumeric() or config["num_threads"] <= 0:
+    if "num_threads" not in config or not isinstance(config["num_threads"], int) or config["num_threads"] <= 0:
         config["num_threads"] = multiprocessing.cpu_count()
+    # maximum number of concurrent requests to the server (the actual number adapts to the server's load)
+    if "max_connections" not in config or not isinstance(config["max_connections"], int) or config["max_connections"] <= 0:
+        config["max_connections"] = 16
+    # same for the number of processes running the analyses
+    if "num_processes" not in config or not isinstance(config["num_processes"], int) or config["num_processes"] < 0:
+        config["num_processes"] = multiprocessing.cpu_count()
+    # number of analyses which can wait for a process before the downloads are paused
+    if "max_pending_scans" not in config or not isinstance(config["max_pending_scans"], int) or config["max_pending_scans"] <= 0:
+        config["max_pending_scans"] = 2 * max(config["num_processes"], 1)
     # if no output path was specified, use a predefined value (e.g. "./workspace_2022-11-14_15-19-23/")
     if "path" not in config or not config["path"]:
         # todo: format based on domain name
         config["path"] = "./{}_{}/".format("confluence", datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
     elif not config["path"].endswith("/"):
         config["path"] += "/"
+    # the cache is kept within the output path by default, it can be shared between outputs
+    if "cache_path" not in config or not config["cache_path"]:
+        config["cache_path"] = config["path"] + "cache.sqlite"
+    if "results_db_path" not in config or not config["results_db_path"]:
+        config["results_db_path"] = config["path"] + "results.sqlite"
+    # the json report of the analysis: time spent in each stage (histograms), by source and by worker
+    if "run_report_path" not in config or not config["run_report_path"]:
+        config["run_report_path"] = config["path"] + "run_report.json"
+    # exposes the metrics of a long analysis in the prometheus text format, through a file rewritten every
+    # `metrics_interval` seconds and/or an http endpoint (0 to disable it)
+    if "metrics_path" not in config:
+        config["metrics_path"] = ""
+    if "metrics_port" not in config or not isinstance(config["metrics_port"], int) or config["metrics_port"] < 0:
+        config["metrics_port"] = 0
+    # profiles the analysis: "cprofile" (deterministic) or "sampling" (the stacks of every thread are sampled every
+    # `profile_interval` seconds), the profiles of every thread and process are merged in the output path
+    if "profile" not in config or config["profile"] not in ("cprofile", "sampling"):
+        config["profile"] = ""
+    if "profile_interval" not in config or not isinstance(config["profile_interval"], (int, float)) or config["profile_interval"] <= 0:
+        config["profile_interval"] = 0.01
+    if "metrics_interval" not in config or not isinstance(config["metrics_interval"], (int, float)) or config["metrics_interval"] <= 0:
+        config["metrics_interval"] = 15
+    # logs the projects and issues done, the download rate, an eta and the slowest project every `progress_interval`
+    # seconds (0 to disable it)
+    if "progress_interval" not in config or not isinstance(config["progress_interval"], (int, float)) or config["progress_interval"] < 0:
+        config["progress_interval"] = 60
     if not config["url"].startswith("http"):
         config["url"] = "https://" + config["url"]
     if config["url"].endswith("/"):
@@ -244,11 +357,12 @@ def main(argv):
     results_path = config["path"] + "results/"
     gitleaks_results_path = config["path"] + "gitleaks/"
     downloads_path = config["path"] + "downloads/"
+    state_path = config["path"] + "state.json"
 
     # connecting to Atlassian account (either through account password or application password)
     logger.debug("connecting to account...")
     url = config["url"] if do_not_use_port else "{}:{}".format(config["url"], config["port"])
-    account = Jira(url=url, username=config["username"], password=config["password"], cloud=True)
+    account = Jira(url=url, username=config["username"], password=config["password"], cloud=True, session=common.create_session(config["max_connections"]))
     logger.info("connected to account: {}".format(config["username"]))
 
     # creates the directory in which the analysis will take place if it doesn't exist
@@ -267,15 +381,68 @@ def main(argv):
         os.mkdir(downloads_path)
 
     logger.debug("compiling regex filters...")
+    whitelist_re = common.compile_source_patterns(config["whitelist"])
+    blacklist_re = common.compile_source_patterns(config["blacklist"])
     for file_filter in config["file_filters"]:
         file_filters_re.append(re.compile(file_filter))
     for content_filter in config["content_filters"]:
         content_filters_re.append(re.compile(content_filter))
 
+    default_rules_path = config["default_rules_path"]
+    use_prefilter = config["use_prefilter"]
+    if config["scan_engine"] == "python" or use_prefilter:
+        try:
+            default_rules_path = common.load_engine_rules(default_rules_path, config["path"], config["scan_engine"])
+        except Exception as e:
+            if config["scan_engine"] == "python":
+                logger.critical("couldn't load the rules of the python engine: {}".format(e))
+                sys.exit(1)
+
+            # the prefilter is only an optimization, the analysis goes on without it
+            logger.error("couldn't load the rules of the prefilter, it is disabled: {}".format(e))
+            use_prefilter = False
+
+    scan_context = common.ScanContext(file_filters_re, content_filters_re, "" if config["do_not_use_cache"] else config["cache_path"],
+                                      common.get_rules_hash(config["scan_engine"], default_rules_path), config["cache_max_entries"],
+                                      config["results_db_path"] if config["use_results_db"] else "", config["scan_engine"], default_rules_path,
+                                      use_prefilter)
+
+    # opens the cache before any analysis (it gets invalidated if the rules have changed)
+    logger.debug("opening scan cache...")
+    scan_cache = scan_context.get_scan_cache()
+    results_store = scan_context.get_results_store()
+
+    # loads the state of the previous analyses
+    state = common.load_state(state_path)
+    if "projects" not in state:
+        state["projects"] = {}
+    previous_state = dict(state["projects"])
+    if config["incremental"] and not state["projects"]:
+        logger.warning("no previous analysis found in the output path, every issue will be analyzed")
+
     # takes the time before analysis (for statistics)
     time_before_analysis = time.time()
-
-    # creates the queue of repo to analyze by the worker threads
+    analysis_start = datetime.datetime.now(datetime.timezone.utc)
+
+    # creates the pipeline running the analyses of the downloaded issues
+    # the profiler is started before any worker thread, so that every one of them is profiled
+    profiler = None
+    profiles_path = config["path"] + "profiles/"
+    if config["profile"]:
+        if not os.path.exists(profiles_path):
+            os.mkdir(profiles_path)
+        profiler = common.Profiler(config["profile"], config["profile_interval"])
+        profiler.start()
+
+    progress = common.ProgressReporter("projects", "issues", config["progress_interval"])
+    pipeline = common.ScanPipeline(config["num_processes"], config["max_pending_scans"], use_debug_mode, filename, config["profile"], config["profile_interval"],
+                                   profiles_path, progress)
+    metrics_exporter = None
+    if config["metrics_path"] or config["metrics_port"]:
+        metrics_exporter = common.MetricsExporter(program_name, pipeline, config["metrics_path"], config["metrics_port"], config["metrics_interval"])
+    progress.start()
+
+    # creates the queue of projects to download by the worker threads
     work_queue = Queue()
 
     # launch as much worker threads as specified by `num_worker_threads`
@@ -289,24 +456,64 @@ def main(argv):
         i += 1
 
     logger.debug("adding analysis tasks...")
-    projects = account.get_all_projects()
+    num_excluded_projects = 0
+    with pipeline.measure("list", ""):
+        projects = account.get_all_projects()
     for project in projects:
         key = project["key"]
         name = project["name"]
+
+        # the excluded projects are never downloaded
+        if not common.is_source_included(key, whitelist_re, blacklist_re):
+            num_excluded_projects += 1
+            continue
+
         work_queue.put((name, account, key, downloads_path, results_path, gitleaks_results_path))
 
+    logger.info("excluded {} projects through the whitelist and blacklist".format(num_excluded_projects))
+    progress.set_total_sources(len(projects) - num_excluded_projects)
+
     # wait for all tasks to finish
     work_queue.join()
+    pipeline.join()
+    pipeline.shutdown()
+    progress.stop()
+
+    # the projects which couldn't be fully analyzed will be analyzed again by the next incremental analysis
+    for key in pipeline.failed_sources:
+        if key in previous_state:
+            state["projects"][key] = previous_state[key]
+        else:
+            state["projects"].pop(key, None)
 
     # saves the time after analysis and shows the time spent analyzing for statistics
     time_after_analysis = time.time()
     logger.info('time spent analyzing: %.2fs', time_after_analysis - time_before_analysis)
+    common.log_filter_statistics(pipeline.statistics, config["file_filters"], config["content_filters"])
+    common.log_prefilter_statistics(pipeline.statistics, "issues")
+
+    # the time spent in each stage of the analysis
+    common.log_stage_metrics(pipeline.statistics)
+    common.save_run_report(config["run_report_path"], common.create_run_report(program_name, pipeline.statistics, analysis_start,
+                                                                               datetime.datetime.now(datetime.timezone.utc), len(projects) - num_excluded_projects, pipeline.failed_sources))
+    if metrics_exporter:
+        metrics_exporter.stop()
+    if profiler:
+        common.save_profile(profiler, config["path"] + "profile", profiles_path)
+
+    # saves the state for the next incremental analysis
+    common.save_state(state_path, state)
 
     if save_config_path:
         save_config_file = open(save_config_path, "w")
         save_config_file.write(json.dumps(config, indent=4))
         save_config_file.close()
 
+    if scan_cache:
+        scan_cache.close()
+    if results_store:
+        results_store.close()
+
     # close the atlassian account
     account.close()
 
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import re
+import sys
+import math
+import bisect
+import common
+import getopt
+import os.path
+import logging
+import requests
+import threading
+import subprocess
+
+try:
+    import tomllib
+except ImportError:
+    # the python engine needs python 3.11 or above
+    tomllib = None
+
+# the program's name
+program_name = "leak_engine"
+# the program's version
+program_version = "1.0.0"
+# the logger to use throughout the module
+logger = logging.getLogger(program_name)
+# the url of the default rules of a given version of gitleaks (pulled by `[extend] useDefault`)
+default_rules_url = "https://raw.githubusercontent.com/gitleaks/gitleaks/v{}/config/gitleaks.toml"
+# the engines compiled by the current process (indexed by their configuration)
+engines = {}
+engines_lock = threading.Lock()
+# the lines containing this signature are ignored by gitleaks
+allow_signature = "gitleaks:allow"
+# the posix classes supported by go, but not by python
+posix_classes = {"alnum": "0-9A-Za-z", "alpha": "A-Za-z", "ascii": "\\x00-\\x7F", "blank": "\\t ", "cntrl": "\\x00-\\x1F\\x7F", "digit": "0-9",
+                 "graph": "!-~", "lower": "a-z", "print": " -~", "punct": "!-/:-@\\[-`{-~", "space": "\\t\\n\\v\\f\\r ", "upper": "A-Z",
+                 "word": "0-9A-Za-z_", "xdigit": "0-9A-Fa-f"}
+
+
+def translate_regex(pattern):
+    # \z is the end of the text in go (python's \Z)
+    pattern = pattern.replace("\\z", "\\Z")
+
+    for name, characters in posix_classes.items():
+        pattern = pattern.replace("[:{}:]".format(name), characters)
+
+    # go applies the flags of a `(?i)` group to the rest of its enclosing group (including its next alternatives), python
+    # only accepts them at the start of the pattern, they are scoped to each of these alternatives instead
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+
+        if in_class:
+            in_class = pattern[i] != "]"
+        elif pattern[i] == "[":
+            in_class = True
+            # a closing bracket right after the opening one is a character of the class
+            if pattern[i + 1:i + 2] == "]":
+                i += 1
+        elif i > 0:
+            flags = re.match(r"\(\?([imsU]+)\)", pattern[i:])
+            if flags:
+                start = i + len(flags.group(0))
+                end = find_group_end(pattern, start)
+                alternatives = split_alternatives(pattern[start:end])
+                scoped_alternatives = "|".join("(?{}:{})".format(flags.group(1).replace("U", ""), alternative) for alternative in alternatives)
+                pattern = pattern[:i] + scoped_alternatives + pattern[end:]
+        i += 1
+
+    return pattern
+
+
+def find_group_end(pattern, i):
+    depth = 0
+    in_class = False
+
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+
+        if in_class:
+            in_class = pattern[i] != "]"
+        elif pattern[i] == "[":
+            in_class = True
+            if pattern[i + 1:i + 2] == "]":
+                i += 1
+        elif pattern[i] == "(":
+            depth += 1
+        elif pattern[i] == ")":
+            if depth == 0:
+                return i
+            depth -= 1
+        i += 1
+
+    return len(pattern)
+
+
+def split_alternatives(pattern):
+    # splits a group at the alternations which aren't within one of its subgroups
+    alternatives = []
+    start = 0
+    depth = 0
+    in_class = False
+    i = 0
+
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+
+        if in_class:
+            in_class = pattern[i] != "]"
+        elif pattern[i] == "[":
+            in_class = True
+            if pattern[i + 1:i + 2] == "]":
+                i += 1
+        elif pattern[i] == "(":
+            depth += 1
+        elif pattern[i] == ")":
+            depth -= 1
+        elif pattern[i] == "|" and depth == 0:
+            alternatives.append(pattern[start:i])
+            start = i + 1
+        i += 1
+
+    alternatives.append(pattern[start:])
+    return alternatives
+
+
+def compile_regex(pattern):
+    return re.compile(translate_regex(pattern)) if pattern else None
+
+
+def shannon_entropy(data):
+    if not data:
+        return 0.0
+
+    # same as gitleaks: the characters are counted over the length in bytes
+    inverse_length = 1.0 / len(data.encode("utf-8"))
+    entropy = 0.0
+    for count in [data.count(character) for character in set(data)]:
+        frequency = count * inverse_length
+        entropy -= frequency * math.log2(frequency)
+
+    return entropy
+
+
+class Allowlist:
+    def __init__(self, allowlist):
+        self.regex_target = allowlist.get("regexTarget", "")
+        self.regexes = [compile_regex(regex) for regex in allowlist.get("regexes", [])]
+        self.paths = [compile_regex(path) for path in allowlist.get("paths", [])]
+        self.stop_words = [stop_word.lower() for stop_word in allowlist.get("stopwords", [])]
+
+    def extend(self, allowlist):
+        self.regexes += allowlist.regexes
+        self.paths += allowlist.paths
+        self.stop_words += allowlist.stop_words
+
+    def is_path_allowed(self, path):
+        return any(regex.search(path) for regex in self.paths)
+
+    def is_allowed(self, secret, match, line):
+        target = {"match": match, "line": line}.get(self.regex_target, secret)
+        if any(regex.search(target) for regex in self.regexes):
+            return True
+
+        secret = secret.lower()
+        return any(stop_word in secret for stop_word in self.stop_words)
+
+
+class Rule:
+    def __init__(self, rule):
+        self.id = rule["id"]
+        self.description = rule.get("description", "")
+        self.regex = compile_regex(rule.get("regex", ""))
+        self.secret_group = rule.get("secretGroup", 0)
+        self.entropy = rule.get("entropy", 0.0)
+        self.path = compile_regex(rule.get("path", ""))
+        self.keywords = [keyword.lower() for keyword in rule.get("keywords", [])]
+        self.tags = rule.get("tags", [])
+        self.allowlists = [Allowlist(allowlist) for allowlist in ([rule["allowlist"]] if "allowlist" in rule else []) + rule.get("allowlists", [])]
+
+
+class LeakEngine:
+    # scans the files within the process with the rules of a gitleaks configuration, the findings are the same as the
+    # ones of `gitleaks detect --no-git`
+    def __init__(self, config_path, default_rules_path=""):
+        self.rules = {}
+        self.allowlist = Allowlist({})
+        # the rules python can't compile are still applied by gitleaks
+        self.skipped_rules = []
+        self.load(config_path, default_rules_path)
+
+        # the rules are applied in the same order as gitleaks
+        self.rules = [self.rules[rule_id] for rule_id in sorted(self.rules)]
+
+    def load(self, config_path, default_rules_path):
+        if tomllib is None:
+            raise RuntimeError("the python engine needs python 3.11 or above")
+
+        file = open(config_path, "rb")
+        config = tomllib.load(file)
+        file.close()
+
+        for rule in config.get("rules", []):
+            try:
+                self.rules[rule["id"]] = Rule(rule)
+            except re.error as e:
+                logger.warning("couldn't compile the rule {}: {}".format(rule["id"], e))
+                self.skipped_rules.append(rule["id"])
+        self.allowlist.extend(Allowlist(config.get("allowlist", {})))
+        if "allowlist" in config and "regexTarget" in config["allowlist"]:
+            self.allowlist.regex_target = config["allowlist"]["regexTarget"]
+
+        # the rules of the extended configuration are only added if they aren't overridden, its allowlist is appended
+        extend = config.get("extend", {})
+        if extend.get("useDefault"):
+            if not default_rules_path:
+                raise ValueError("the default rules of gitleaks are needed by {}".format(config_path))
+            self.load_extension(default_rules_path)
+        elif extend.get("path"):
+            self.load_extension(extend["path"])
+
+    def load_extension(self, config_path):
+        extension = LeakEngine(config_path)
+        for rule in extension.rules:
+            if rule.id not in self.rules:
+                self.rules[rule.id] = rule
+        self.skipped_rules.extend(rule_id for rule_id in extension.skipped_rules if rule_id not in self.rules)
+        self.allowlist.extend(extension.allowlist)
+
+    def scan_directory(self, path):
+        findings = []
+
+        # gitleaks doesn't analyze the git directory nor follow the symlinks
+        for root, directories, files in os.walk(path):
+            directories[:] = [directory for directory in directories if directory != ".git"]
+            for file in files:
+                file_path = os.path.join(root, file)
+                if not os.path.islink(file_path):
+                    findings.extend(self.scan_file(file_path))
+
+        return findings
+
+    def scan_file(self, path):
+        file = open(path, "rb")
+        content = file.read()
+        file.close()
+
+        # gitleaks skips the binary files
+        if b"\x00" in content[:512]:
+            return []
+
+        return self.scan(content.decode("utf-8", errors="replace"), path)
+
+    def scan(self, content, path):
+        findings = []
+
+        if self.allowlist.is_path_allowed(path):
+            return findings
+
+        lowered_content = content.lower()
+        newlines = [match.start() for match in re.finditer("\n", content)]
+
+        for rule in self.rules:
+            if rule.keywords and not any(keyword in lowered_content for keyword in rule.keywords):
+                continue
+            findings.extend(self.scan_rule(rule, content, path, newlines))
+
+        return findings
+
+    def scan_rule(self, rule, content, path, newlines):
+        findings = []
+
+        if rule.path:
+            if not rule.path.search(path):
+                return findings
+
+            # the rules without regex only look for the files themselves
+            if not rule.regex:
+                return [self.create_finding(rule, path, "file detected: {}".format(path), "", 1, 1, 0, 0, 0.0, "")]
+
+        if any(allowlist.is_path_allowed(path) for allowlist in rule.allowlists) or not rule.regex:
+            return findings
+
+        for match in rule.regex.finditer(content):
+            match_string = match.group(0).strip("\n")
+            (start_line, end_line, start_column, end_column, line) = self.locate(content, newlines, match.start(), match.end())
+
+            if allow_signature in line:
+                continue
+
+            # the secret is the first group of the match by default, or the one defined by the rule
+            groups = rule.regex.search(match_string)
+            groups = [groups.group(0)] + list(groups.groups()) if groups else []
+            secret = match_string
+            if rule.secret_group == 0:
+                if len(groups) >= 2:
+                    secret = groups[1] or ""
+            elif len(groups) <= rule.secret_group:
+                continue
+            else:
+                secret = groups[rule.secret_group] or ""
+
+            if any(allowlist.is_allowed(secret, match_string, line) for allowlist in rule.allowlists) or self.allowlist.is_allowed(secret, match_string, line):
+                continue
+
+            entropy = shannon_entropy(secret)
+            if rule.entropy:
+                if entropy <= rule.entropy:
+                    continue
+                # the generic rules also need a digit within their secrets
+                if rule.id.startswith("generic") and not any(character.isdigit() for character in secret):
+                    continue
+
+            findings.append(self.create_finding(rule, path, match_string, secret, start_line, end_line, start_column, end_column, entropy, line))
+
+        return findings
+
+    @staticmethod
+    def locate(content, newlines, start, end):
+        # same as gitleaks: the lines are numbered from 1 and the columns are computed from the previous newline, the lines
+        # of the match are found by bisection (a file can have many lines and many matches)
+        newlines = newlines or [len(content)]
+        start_line = end_line = start_column = end_column = None
+        start_line_index = 0
+        end_line_index = len(content)
+
+        # the first line ending after the start of the match, and the first one ending at or after its end
+        start_line_number = bisect.bisect_right(newlines, start)
+        end_line_number = bisect.bisect_left(newlines, end)
+        has_start = start_line_number < len(newlines)
+        has_end = end_line_number < len(newlines) and (newlines[end_line_number - 1] if end_line_number else 0) < end
+
+        # an empty match at the start of a line ends on the previous one
+        if has_end and end_line_number < start_line_number:
+            end_line = end_line_number
+            end_column = end - (newlines[end_line_number - 1] if end_line_number else 0)
+        if has_start:
+            start_line = end_line = start_line_number
+            start_line_index = newlines[start_line_number - 1] if start_line_number else 0
+            start_column = start - start_line_index + 1
+            end_line_index = newlines[start_line_number]
+        if has_end and end_line_number >= start_line_number:
+            end_line = end_line_number
+            end_column = end - (newlines[end_line_number - 1] if end_line_number else 0)
+            end_line_index = newlines[end_line_number]
+
+        # the match is on the last line, after the last newline
+        if start_line is None:
+            start_line = end_line = len(newlines)
+            start_line_index = newlines[-1]
+            start_column = start - newlines[-1] + 1
+            end_column = end - newlines[-1]
+            end_line_index = end
+            while end_line_index < len(content) and content[end_line_index] not in "\r\n":
+                end_line_index += 1
+
+        end_line_index = max(end_line_index, end)
+
+        return start_line + 1, end_line + 1, start_column, end_column, content[start_line_index:end_line_index]
+
+    @staticmethod
+    def create_finding(rule, path, match, secret, start_line, end_line, start_column, end_column, entropy, line):
+        return {"Description": rule.description, "StartLine": start_line, "EndLine": end_line, "StartColumn": start_column, "EndColumn": end_column,
+                "Match": match, "Secret": secret, "File": path, "SymlinkFile": "", "Commit": "", "Entropy": entropy, "Author": "", "Email": "",
+                "Date": "", "Message": "", "Tags": rule.tags, "RuleID": rule.id, "Fingerprint": "{}:{}:{}".format(path, rule.id, start_line)}
+
+
+def get_engine(config_path, default_rules_path):
+    # the rules are compiled once per process
+    with engines_lock:
+        if (config_path, default_rules_path) not in engines:
+            engines[(config_path, default_rules_path)] = LeakEngine(config_path, default_rules_path)
+        return engines[(config_path, default_rules_path)]
+
+
+def get_default_rules_path(directory):
+    version = subprocess.run(["gitleaks", "version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip().lstrip("v")
+    path = "{}gitleaks-{}.toml".format(directory, version)
+
+    # the default rules are embedded within gitleaks, they are downloaded once for each version
+    if not os.path.exists(path):
+        logger.info("downloading the default rules of gitleaks {}...".format(version))
+        response = requests.get(default_rules_url.format(version), timeout=60)
+        response.raise_for_status()
+
+        file = open(path, "w")
+        file.write(response.text)
+        file.close()
+
+    return path
+
+
+def get_finding_key(finding):
+    return finding["File"], finding["RuleID"], finding["StartLine"], finding["Secret"]
+
+
+def check_parity(path, default_rules_path, report_path):
+    # analyzes the same files with gitleaks and the engine, their findings should be the same
+    common.run_gitleaks(path, report_path)
+    gitleaks_findings = set(get_finding_key(finding) for finding in common.read_gitleaks_report(report_path))
+    if os.path.exists(report_path):
+        os.remove(report_path)
+
+    engine = LeakEngine(common.gitleaks_config_path, default_rules_path)
+    engine_findings = set(get_finding_key(finding) for finding in (engine.scan_directory(path) if os.path.isdir(path) else engine.scan_file(path)))
+
+    for finding in sorted(gitleaks_findings - engine_findings, key=str):
+        logger.info("only found by gitleaks: {}".format(finding))
+    for finding in sorted(engine_findings - gitleaks_findings, key=str):
+        logger.info("only found by the engine: {}".format(finding))
+
+    logger.info("gitleaks: {} findings, engine: {} findings, common: {} findings".format(len(gitleaks_findings), len(engine_findings),
+                                                                                         len(gitleaks_findings & engine_findings)))
+
+    return gitleaks_findings == engine_findings
+
+
+def print_help():
+    logger.info("usage: {}.py [options...]".format(program_name))
+    logger.info("")
+    logger.info("checks that the engine finds the same leaks as gitleaks within the given files")
+    logger.info("")
+    logger.info("options:")
+    logger.info("\t-s, --source       path of the file or directory to analyze")
+    logger.info("\t-d, --default      path of the default rules of gitleaks (downloaded if not given)")
+    logger.info("\t-V, --verbose      enables the debug logging mode")
+    logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
+    logger.info("\t-h, --help         shows this help message and exits")
+    logger.info("\t-v, --version      shows the program's version and exits")
+
+
+def print_version():
+    logger.info("{} version: {}".format(program_name, program_version))
+
+
+def main(argv):
+    source_path = ""
+    default_rules_path = ""
+
+    if not common.is_gitleaks_installed():
+        logger.critical("gitleaks needs to be installed!")
+        sys.exit(1)
+
+    try:
+        # getopt is used to define the list of options the program should accept
+        opts, args = getopt.getopt(argv, "s:d:Vl:hv", ["source=", "default=", "verbose", "log=", "help", "version"])
+
+        filename = ""
+        use_debug_mode = False
+        for opt, arg in opts:
+            if opt in ("-V", "--verbose"):
+                use_debug_mode = True
+            elif opt in ("-l", "--log"):
+                filename = arg
+
+        # initializes the logging system
+        common.initialize_logger(use_debug_mode, filename)
+
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print_help()
+                sys.exit()
+            elif opt in ("-v", "--version"):
+                print_version()
+                sys.exit()
+            elif opt in ("-s", "--source"):
+                source_path = arg
+            elif opt in ("-d", "--default"):
+                default_rules_path = arg
+
+        # checks if the necessary settings have been provided
+        if not source_path or not os.path.exists(source_path):
+            print_help()
+            sys.exit(1)
+
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(1)
+
+    if not default_rules_path:
+        default_rules_path = get_default_rules_path("./")
+
+    if not check_parity(source_path, default_rules_path, "./parity.json"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys
+import common
+import getopt
+import os.path
+import logging
+
+# the program's name
+program_name = "results_db"
+# the program's version
+program_version = "1.0.0"
+# the logger to use throughout the program
+logger = logging.getLogger(program_name)
+
+
+def export_results(results_store, export_path, source):
+    if not export_path.endswith("/"):
+        export_path += "/"
+
+    # creates the directory in which the csv files will be exported if it doesn't exist
+    if not os.path.exists(export_path):
+        os.makedirs(export_path)
+
+    # regenerates the csv file of every document, as written without the results database
+    documents = results_store.get_documents(source)
+    for document, document_source, message in documents:
+        path = "{}{}.csv".format(export_path, document)
+        common.serialize_csv(path, results_store.get(path), message)
+
+    logger.info("exported {} documents to: {}".format(len(documents), export_path))
+
+
+def print_results(results_store, source, rule_id, fingerprint):
+    rows = results_store.query(source, rule_id, fingerprint)
+
+    for row in rows:
+        print(";".join(value.replace(";", "\\;") for value in row))
+
+    logger.info("{} results found".format(len(rows)))
+
+
+def print_help():
+    logger.info("usage: {}.py [options...]".format(program_name))
+    logger.info("")
+    logger.info("you will need to provide at least the path of a results database (results.sqlite in the output path of an analysis)")
+    logger.info("the results are printed as: source;document;file;line;secret;comment;rule id;fingerprint")
+    logger.info("")
+    logger.info("options:")
+    logger.info("\t-d, --database     path of the results database")
+    logger.info("\t-S, --source       only keeps the results of a source (space, project or repository)")
+    logger.info("\t-r, --rule         only keeps the results of a gitleaks rule")
+    logger.info("\t-f, --fingerprint  only keeps the results with a gitleaks fingerprint")
+    logger.info("\t-e, --export       path of a directory in which the csv file of every document will be exported")
+    logger.info("\t-V, --verbose      enables the debug logging mode")
+    logger.info("\t-l, --log          name of the log file (it will save every logs of the program)")
+    logger.info("\t-h, --help         shows this help message and exits")
+    logger.info("\t-v, --version      shows the program's version and exits")
+
+
+def print_version():
+    logger.info("{} version: {}".format(program_name, program_version))
+
+
+def main(argv):
+    database_path = ""
+    export_path = ""
+    source = None
+    rule_id = None
+    fingerprint = None
+
+    try:
+        # getopt is used to define the list of options the program should accept
+        opts, args = getopt.getopt(argv, "d:S:r:f:e:Vl:hv", ["database=", "source=", "rule=", "fingerprint=", "export=", "verbose", "log=", "help", "version"])
+
+        filename = ""
+        use_debug_mode = False
+        for opt, arg in opts:
+            if opt in ("-V", "--verbose"):
+                use_debug_mode = True
+            elif opt in ("-l", "--log"):
+                filename = arg
+
+        # initializes the logging system
+        common.initialize_logger(use_debug_mode, filename)
+
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print_help()
+                sys.exit()
+            elif opt in ("-v", "--version"):
+                print_version()
+                sys.exit()
+            elif opt in ("-d", "--database"):
+                database_path = arg
+            elif opt in ("-S", "--source"):
+                source = arg
+            elif opt in ("-r", "--rule"):
+                rule_id = arg
+            elif opt in ("-f", "--fingerprint"):
+                fingerprint = arg
+            elif opt in ("-e", "--export"):
+                export_path = arg
+
+        # checks if the necessary settings have been provided
+        if not database_path or not os.path.exists(database_path):
+            print_help()
+            sys.exit(1)
+
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(1)
+
+    results_store = common.ResultsStore(database_path)
+
+    if export_path:
+        export_results(results_store, export_path, source)
+    else:
+        print_results(results_store, source, rule_id, fingerprint)
+
+    results_store.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,7 @@
+# coding: utf-8
+
+import os
+import sys
+
+# the modules under test are next to the tests directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+import os
+import re
+
+import pytest
+
+import common
+
+
+def create_finding(file, match="password=hunter2", line=2):
+    return {"Description": "Generic Password", "StartLine": line, "EndLine": line, "StartColumn": 1, "EndColumn": len(match), "Match": match, "Secret": "hunter2",
+            "File": file, "SymlinkFile": "", "Commit": "", "Entropy": 2.5, "Author": "", "Email": "", "Date": "", "Message": "", "Tags": [],
+            "RuleID": "generic-password", "Fingerprint": "{}:generic-password:{}".format(file, line)}
+
+
+def create_leak(file):
+    return common.GitLeak("password=hunter2", "hunter2", "generic-password", "2.5", file, "2", "{}:generic-password:2".format(file))
+
+
+@pytest.mark.parametrize("file", ["./out/downloads/123.html", "out/downloads/123.html", "/tmp/out/downloads/123.html"])
+def test_gitleaks_to_csv_documents(file):
+    # the documents are in the downloads path, whether the output path is relative or absolute
+    csv = common.gitleaks_to_csv([create_leak(file)], "123")
+    assert [(line.file, line.line, line.secret) for line in csv] == [("123.html", "2", "password=hunter2")]
+
+
+@pytest.mark.parametrize("file", ["./out/clones/api/src/api/x.py", "/tmp/out/clones/api/src/api/x.py"])
+def test_gitleaks_to_csv_clones(file):
+    # the name of the repository may appear again in the path of its files
+    csv = common.gitleaks_to_csv([create_leak(file)], "api")
+    assert csv[0].file == "api/src/api/x.py"
+
+
+def test_gitleaks_to_csv_history():
+    # the files found in the git history are relative to the repository
+    csv = common.gitleaks_to_csv([create_leak("src/api/x.py")], "api", True)
+    assert csv[0].file == "api/src/api/x.py"
+
+
+@pytest.mark.parametrize("relative", [True, False])
+def test_process_gitleaks_report_keeps_comments(tmp_path, monkeypatch, relative):
+    # the triage comments of the last analysis are carried over and the finding isn't reported as resolved
+    monkeypatch.chdir(tmp_path)
+    downloads_path = "./out/downloads/" if relative else str(tmp_path / "out" / "downloads") + "/"
+    os.makedirs(downloads_path)
+    log_file_path = str(tmp_path / "123.log")
+    processed_log_file_path = str(tmp_path / "123.csv")
+
+    common.serialize_gitleaks(log_file_path, [create_finding(downloads_path + "123.html")])
+    common.serialize_csv(processed_log_file_path, [common.LeakCsv("123.html", "2", "password=hunter2", "triaged: false positive")])
+
+    common.process_gitleaks_report(log_file_path, processed_log_file_path, "123", [], [])
+
+    csv = common.deserialize_csv(processed_log_file_path)
+    assert [(line.file, line.line, line.secret, line.comment) for line in csv] == [("123.html", "2", "password=hunter2", "triaged: false positive")]
+
+
+@pytest.mark.parametrize("patterns", [
+    [r"(?i)example", r"\$\{[A-Z_]+\}", r"x{8,}", r"(?ms)^key.value$", r"/tests?/"],
+    # the filters which can't be combined are searched one by one
+    [r"(?i)example", r"(a)\1"],
+    [r"(?P<name>example)", r"(?P<name>tests?)"],
+    [],
+])
+def test_find_filter_combined(patterns):
+    # the combined filters exclude the same findings and credit the same filter as the filters searched one by one
+    filters_re = [re.compile(pattern) for pattern in patterns]
+    combined_re = common.combine_filters(filters_re)
+
+    for text in ["an EXAMPLE", "${API_KEY}", "xxxxxxxxxx", "a\nkey\nvalue\n", "src/tests/a.py", "aa", "password=hunter2", "KEY\nVALUE"]:
+        assert common.find_filter(filters_re, text, combined_re) is common.find_filter(filters_re, text), text
+
+
+@pytest.mark.parametrize("file", ["./out/shards/shard-x/src/a.py", "out/shards/shard-x/src/a.py", os.path.abspath("out/shards/shard-x/src/a.py")])
+def test_relocate_finding(file):
+    # gitleaks may print the staged path cleaned or absolute
+    finding = create_finding(file)
+    common.relocate_finding(finding, "./out/shards/shard-x", "./out/clones/api")
+    assert finding["File"] == "./out/clones/api/src/a.py"
+    assert finding["Fingerprint"] == "./out/clones/api/src/a.py:generic-password:2"
+
+
+def test_relocate_finding_document():
+    # the documents of a batch are staged as single files
+    finding = create_finding("out/staging/staging-x/123.html")
+    common.relocate_finding(finding, "./out/staging/staging-x/123.html", "./out/downloads/123.html")
+    assert finding["File"] == "./out/downloads/123.html"
+
+
+def test_process_gitleaks_report_warns_lost_comments(tmp_path, caplog):
+    # a comment of the older secret format can't be carried over, the leak still found at the same line is reported
+    log_file_path = str(tmp_path / "123.log")
+    processed_log_file_path = str(tmp_path / "123.csv")
+    common.serialize_gitleaks(log_file_path, [create_finding(str(tmp_path / "downloads" / "123.html"))])
+    common.serialize_csv(processed_log_file_path, [common.LeakCsv("123.html", "2", "Secret: hunter2 Match: password=hunter2", "triaged: false positive")])
+
+    common.process_gitleaks_report(log_file_path, processed_log_file_path, "123", [], [])
+
+    assert "1 comment(s) of 123 weren't carried over" in caplog.text
+    assert [line.comment for line in common.deserialize_csv(processed_log_file_path)] == [""]
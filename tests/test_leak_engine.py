@@ -0,0 +1,106 @@
+# coding: utf-8
+
+import os
+import re
+import shutil
+
+import pytest
+
+import common
+import leak_engine
+
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+config_path = os.path.join(fixtures_path, "gitleaks.toml")
+parity_path = os.path.join(fixtures_path, "parity")
+
+# the findings of the fixtures: file (relative to the fixtures), rule and line
+expected_findings = {("config.env", "aws-access-key", 2), ("config.env", "generic-password", 4), ("config.env", "api-key", 5), ("config.env", "api-key", 6),
+                     ("keys/server.pem", "private-key-file", 1), ("last_line.txt", "generic-password", 1), ("notes.md", "github-pat", 3),
+                     ("notes.md", "generic-password", 7), ("notes.md", "aws-access-key", 8)}
+
+requires_tomllib = pytest.mark.skipif(leak_engine.tomllib is None, reason="the python engine needs python 3.11 or above")
+requires_gitleaks = pytest.mark.skipif(shutil.which("gitleaks") is None, reason="gitleaks isn't installed")
+
+
+@pytest.mark.parametrize("pattern, matches, mismatches", [
+    # the flags apply to the rest of the group, including its next alternatives
+    ("x(?i)y|z", ["xy", "xY", "z", "Z"], ["XY", "Xy"]),
+    ("a(b(?i)c|d)e", ["abce", "abCe", "aDe"], ["Abce", "abcE", "aBce"]),
+    # an alternation within a character class or a subgroup doesn't split the group
+    ("k[|]y(?i)q|w", ["k|yQ", "W"], ["K|yq"]),
+    ("x(?i)(y|z)w", ["xYW", "xzw"], ["XyW"]),
+    ("(?i)abc", ["ABC", "abc"], []),
+])
+def test_translate_regex_scopes_flags(pattern, matches, mismatches):
+    regex = leak_engine.compile_regex(pattern)
+    for text in matches:
+        assert regex.fullmatch(text), text
+    for text in mismatches:
+        assert not regex.fullmatch(text), text
+
+
+def test_translate_regex_posix_classes():
+    regex = leak_engine.compile_regex(r"[[:alpha:]]+[[:digit:]]\z")
+    assert regex.search("abc1")
+    assert not regex.search("abc1\n")
+
+
+@pytest.mark.parametrize("content, start, end, expected", [
+    ("abc", 1, 2, (1, 1, 2, 2, "abc")),
+    # same as gitleaks: the columns are counted from the newline ending the previous line
+    ("one\ntwo\nthree", 4, 7, (2, 2, 2, 4, "\ntwo")),
+    ("one\ntwo\nthree", 1, 6, (1, 2, 2, 3, "one\ntwo")),
+    # the line of a match after the last newline is only the last line
+    ("one\ntwo\nthree", 9, 13, (3, 3, 3, 6, "\nthree")),
+    ("a gitleaks:allow\nsecret", 17, 23, (2, 2, 2, 7, "\nsecret")),
+])
+def test_locate(content, start, end, expected):
+    newlines = [match.start() for match in re.finditer("\n", content)]
+    assert leak_engine.LeakEngine.locate(content, newlines, start, end) == expected
+
+
+def test_locate_many_lines():
+    content = "".join("line {}\n".format(i) for i in range(100000)) + "secret"
+    newlines = [match.start() for match in re.finditer("\n", content)]
+    start = content.index("line 54321")
+    assert leak_engine.LeakEngine.locate(content, newlines, start, start + 10)[:4] == (54322, 54322, 2, 11)
+    assert leak_engine.LeakEngine.locate(content, newlines, len(content) - 6, len(content))[:2] == (100001, 100001)
+
+
+@requires_tomllib
+def test_engine_findings():
+    engine = leak_engine.LeakEngine(config_path)
+    findings = set((os.path.relpath(finding["File"], parity_path), finding["RuleID"], finding["StartLine"]) for finding in engine.scan_directory(parity_path))
+    assert findings == expected_findings
+
+
+@requires_tomllib
+@requires_gitleaks
+def test_parity_with_gitleaks(monkeypatch, tmp_path):
+    monkeypatch.setattr(common, "gitleaks_config_path", config_path)
+    assert leak_engine.check_parity(parity_path, "", str(tmp_path / "report.json"))
+
+
+@requires_tomllib
+@requires_gitleaks
+def test_parity_with_default_rules(tmp_path):
+    # the default rules of the installed gitleaks are downloaded once
+    try:
+        default_rules_path = leak_engine.get_default_rules_path(str(tmp_path) + "/")
+    except Exception as e:
+        pytest.skip("couldn't download the default rules of gitleaks: {}".format(e))
+
+    assert leak_engine.check_parity(parity_path, default_rules_path, str(tmp_path / "report.json"))
+
+
+@requires_tomllib
+def test_skipped_rules(monkeypatch, tmp_path):
+    # gitleaks still applies the rules python can't compile, the prefilter can't be built from the other ones
+    path = tmp_path / "gitleaks.toml"
+    path.write_text("[extend]\npath = '''{}'''\n\n[[rules]]\nid = \"ungreedy\"\nregex = '''(?U)secret=.+'''\nkeywords = [\"secret\"]\n".format(config_path))
+    monkeypatch.setattr(common, "gitleaks_config_path", str(path))
+
+    assert leak_engine.LeakEngine(str(path)).skipped_rules == ["ungreedy"]
+    assert common.load_engine_rules("unused", "", "python") == "unused"
+    with pytest.raises(RuntimeError, match="ungreedy"):
+        common.load_engine_rules("unused", "", "gitleaks")